@@ -212,6 +212,7 @@ export enum IpcChannel {
   WxAuto_ClearChatMessages = 'wxauto:clear-chat-messages',
   WxAuto_RefreshChatMessages = 'wxauto:refresh-chat-messages',
   WxAuto_GetMessagesFromDb = 'wxauto:get-messages-from-db',
+  WxAuto_GetMoreMessagesFromDb = 'wxauto:get-more-messages-from-db',
   WxAuto_StartMonitoring = 'wxauto:start-monitoring',
   WxAuto_StopMonitoring = 'wxauto:stop-monitoring',
   WxAuto_GetAutoReplyStatus = 'wxauto:get-auto-reply-status',
@@ -11,18 +11,41 @@ import json
 import time
 import logging
 import threading
-import traceback
 import sqlite3
 import os
+import operator
+import hashlib
+import random
+import secrets
 import requests
-from typing import Dict, Any, List, Optional
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, List, Optional, Callable
 import signal
 from datetime import datetime
 import locale
 from queue import Queue, Empty
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from wxautox.msgs import *
+
+# 可选：orjson解析JSON更快，未安装时使用标准库json
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# 解析JSON（str或bytes），orjson不可用时使用json
+_json_loads = orjson.loads if ORJSON_AVAILABLE else json.loads
+
+def _json_dumps_bytes(obj: Any) -> bytes:
+    """序列化为UTF-8编码的JSON bytes（用作HTTP请求体），orjson不可用时使用json"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
 # 设置控制台编码为UTF-8
 if sys.platform.startswith('win'):
     import ctypes
@@ -43,9 +66,16 @@ class UTF8Formatter(logging.Formatter):
                 record.msg = record.msg.encode('utf-8', errors='replace').decode('utf-8')
         return super().format(record)
 
-# 创建日志记录器
+# 创建日志记录器，级别可通过WXAUTO_LOG_LEVEL环境变量调整（默认INFO，排查问题时设为DEBUG输出详细日志）
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+_log_level_name = os.environ.get('WXAUTO_LOG_LEVEL', 'INFO').upper()
+_log_level = logging.getLevelName(_log_level_name)  # 已知的级别名返回对应数值，否则返回字符串
+_log_level_valid = isinstance(_log_level, int)
+# 无效的级别名不影响启动，使用默认级别INFO，处理器配置好后再输出警告
+logger.setLevel(_log_level if _log_level_valid else logging.INFO)
+
+# 是否输出消息对象的完整属性列表（dir()开销较大，仅排查问题时开启）
+VERBOSE_DEBUG = os.environ.get('WXAUTO_VERBOSE_DEBUG') == '1'
 
 # 创建控制台处理器
 console_handler = logging.StreamHandler(sys.stdout)
@@ -64,12 +94,250 @@ file_handler.setLevel(logging.DEBUG)
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 
+if not _log_level_valid:
+    logger.warning(f"无效的日志级别 WXAUTO_LOG_LEVEL={_log_level_name}，使用默认级别INFO")
+
 # 数据库配置
 DB_PATH = 'wechat_data.db'
 
+# SQLite 3.25+ 支持窗口函数，可在分页查询中同时返回总数
+SQLITE_HAS_WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)
+
+# SQLite 3.24+ 支持 UPSERT（ON CONFLICT ... DO UPDATE）
+SQLITE_SUPPORTS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# 保存会话信息：已存在时只更新名称和时间，保留created_at、is_monitoring等字段
+# 旧版SQLite退回 INSERT OR REPLACE
+if SQLITE_SUPPORTS_UPSERT:
+    SQL_UPSERT_SESSION = '''
+    INSERT INTO sessions (session_id, wxid, name, type, last_time, created_at, updated_at, chat_type)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(session_id, wxid) DO UPDATE SET
+        name = excluded.name,
+        last_time = excluded.last_time,
+        updated_at = excluded.updated_at
+    '''
+else:
+    SQL_UPSERT_SESSION = '''
+    INSERT OR REPLACE INTO sessions (session_id, wxid, name, type, last_time, created_at, updated_at, chat_type)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+
+# 开始监听：写入会话并设置is_monitoring，保留created_at、has_more_messages
+if SQLITE_SUPPORTS_UPSERT:
+    SQL_UPSERT_SESSION_MONITORING = '''
+    INSERT INTO sessions (session_id, wxid, name, type, last_time, created_at, updated_at, chat_type, is_monitoring)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(session_id, wxid) DO UPDATE SET
+        name = excluded.name,
+        last_time = excluded.last_time,
+        updated_at = excluded.updated_at,
+        is_monitoring = excluded.is_monitoring
+    '''
+else:
+    SQL_UPSERT_SESSION_MONITORING = '''
+    INSERT OR REPLACE INTO sessions (session_id, wxid, name, type, last_time, created_at, updated_at, chat_type, is_monitoring)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+
+# 停止监听
+SQL_STOP_SESSION_MONITORING = '''
+UPDATE sessions SET is_monitoring = 0, updated_at = ?, last_time = ?
+WHERE session_id = ? AND wxid = ?
+'''
+
+# 写入消息（同一会话中hash相同的消息只保留一条，见ux_messages_session_hash）
+SQL_INSERT_MESSAGE = '''
+INSERT OR IGNORE INTO messages (session_id, wxid, content, is_self, timestamp, extra_data, msg_type, sender, attr, original_time, formatted_time, hash)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# SQL_INSERT_MESSAGE的一行参数，字段顺序与其中的列一致
+_MessageRow = namedtuple(
+    '_MessageRow',
+    'session_id wxid content is_self timestamp extra_data msg_type sender attr original_time formatted_time hash'
+)
+
+# messages表的会话分页索引，批量导入时会先删除再重建
+SQL_CREATE_MESSAGES_SESSION_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idx_messages_session_wxid_id ON messages(session_id, wxid, id)"
+)
+
+# messages表按时间排序使用的索引（时间相同时按id），批量导入时同样先删除再重建
+SQL_CREATE_MESSAGES_TIMESTAMP_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idx_messages_session_wxid_ts ON messages(session_id, wxid, timestamp, id)"
+)
+
+# reply_suggestions表按会话、时间倒序查询使用的索引
+SQL_CREATE_REPLY_SUGGESTIONS_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idx_rs_session_wxid_ts ON reply_suggestions(session_id, wxid, timestamp DESC)"
+)
+
+# ai_sales_config中可由前端更新的字段（同时作为拼接SQL列名的白名单）
+AI_SALES_CONFIG_FIELDS = (
+    'api_key', 'api_url', 'model_name', 'temperature', 'max_tokens', 'system_prompt',
+    'auto_reply_prompt', 'reply_suggest_prompt', 'auto_reply_enabled', 'reply_suggest_enabled'
+)
+
+# 新建AI销冠配置时的默认值
+AI_SALES_CONFIG_DEFAULTS = {
+    'model_name': 'gpt-3.5-turbo',
+    'temperature': 0.7,
+    'max_tokens': 2000,
+    'auto_reply_enabled': False,
+    'reply_suggest_enabled': False,
+}
+
+# 批量导入超过该条数时，先删除索引、写入后再重建
+BULK_LOAD_INDEX_THRESHOLD = 200
+
+# 批量导入超过该条数时，写入后更新查询规划器的统计信息
+BULK_LOAD_ANALYZE_THRESHOLD = 500
+
+# 批量导入时每次executemany写入的行数
+BULK_INSERT_CHUNK_SIZE = 5000
+
 # 全局wxid变量，用于数据隔离
 CURRENT_WXID = None
 
+# 私聊会话ID前缀：session_id = PRIVATE_SESSION_PREFIX + 联系人名称
+PRIVATE_SESSION_PREFIX = 'private_self_'
+
+def _private_session_id(contact_name: str) -> str:
+    """联系人的私聊会话ID"""
+    return PRIVATE_SESSION_PREFIX + contact_name
+
+# 会话ID前缀（私聊、群聊），去掉前缀后是联系人或群名称
+_SESSION_PREFIXES = (PRIVATE_SESSION_PREFIX, 'group_')
+
+# extra_data的两种固定取值（已序列化）
+EXTRA_TEXT = '{"message_type": "text"}'
+EXTRA_TIME = '{"message_type": "time"}'
+
+# extra_data常见取值的JSON缓存，批量入库时避免逐行重复序列化
+_EXTRA_JSON_CACHE = {
+    (('message_type', 'text'),): EXTRA_TEXT,
+    (('message_type', 'time'),): EXTRA_TIME,
+}
+
+def _dump_extra_data(extra_data: Optional[Dict[str, Any]]) -> Optional[str]:
+    """序列化extra_data，常见取值直接命中缓存，空字典返回None"""
+    if not extra_data:
+        return None
+    try:
+        cached = _EXTRA_JSON_CACHE.get(tuple(extra_data.items()))
+    except TypeError:
+        # 值不可哈希（如列表），走常规序列化
+        cached = None
+    if cached is not None:
+        return cached
+    return json.dumps(extra_data, separators=(',', ':'))
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+@lru_cache(maxsize=1024)
+def _format_timestamp(timestamp: int) -> str:
+    """把Unix时间戳格式化为本地时间字符串，同一批消息大多共用时间戳，直接复用缓存结果"""
+    return time.strftime(DATETIME_FORMAT, time.localtime(timestamp))
+
+# OpenAI兼容接口：未配置api_url时使用的默认代理地址，以及调用失败后依次尝试的备用地址
+DEFAULT_API_URL = "https://api.openai-proxy.com/v1/chat/completions"
+OFFICIAL_API_URL = "https://api.openai.com/v1/chat/completions"
+_FALLBACK_API_URLS = (
+    OFFICIAL_API_URL,
+    "https://openai.wndbac.cn/v1/chat/completions",
+    "https://proxy.geekai.co/v1/chat/completions",
+)
+
+# 备用API超过该秒数仍未返回时，开始请求下一个备用API
+FALLBACK_API_HEDGE_DELAY = 5
+
+@lru_cache(maxsize=8)
+def _auth_headers(api_key: str) -> Dict[str, str]:
+    """按api_key缓存API请求头（返回的字典是共享的，调用方不要修改）"""
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+
+# 一次读取wxautox消息对象的常用属性（C实现，比逐个getattr快）
+_get_message_fields = operator.attrgetter('content', 'sender', 'attr', 'type', 'time', 'hash')
+
+# 监听线程中预先取出的消息字段
+_MonitoredMessage = namedtuple('_MonitoredMessage', 'sender content time attr')
+
+# 监听线程中每个联系人保留的已处理消息指纹数，超出后按加入顺序淘汰最早的
+MONITOR_DEDUP_CACHE_SIZE = 100
+
+# 字典消息中有独立列存储的字段，其余字段写入extra_data
+_DICT_MESSAGE_KNOWN_KEYS = frozenset((
+    'content', 'is_self', 'timestamp', 'sender', 'attr', 'original_time', 'time', 'msg_type'
+))
+
+# 各种来源的消息统一解析后的字段，见_parse_object_message/_parse_dict_message
+_ParsedMessage = namedtuple(
+    '_ParsedMessage',
+    'content is_self timestamp sender attr original_time formatted_time msg_type extra_data hash'
+)
+
+def _parse_object_message(msg: Any, i: int, current_time: int) -> _ParsedMessage:
+    """解析wxautox消息对象，时间缺失或解析失败时用当前时间加消息序号，避免时间戳重复"""
+    content = getattr(msg, 'content', '')
+    sender = getattr(msg, 'sender', '')
+    attr = getattr(msg, 'attr', '')
+    msg_time = getattr(msg, 'time', None)
+
+    timestamp = current_time + i
+    if msg_time:
+        try:
+            if isinstance(msg_time, str) and ":" in msg_time:
+                # 格式如 "14:30"
+                today = datetime.now().strftime("%Y-%m-%d")
+                dt = datetime.strptime(f"{today} {msg_time}", "%Y-%m-%d %H:%M")
+                timestamp = int(dt.timestamp())
+            else:
+                timestamp = int(float(msg_time))
+        except:
+            timestamp = current_time + i
+
+    return _ParsedMessage(
+        content=content,
+        is_self=(attr == 'self'),
+        timestamp=timestamp,
+        sender=sender,
+        attr=attr,
+        original_time=str(msg_time) if msg_time else '',
+        formatted_time=_format_timestamp(timestamp),
+        msg_type=getattr(msg, 'type', ''),
+        # sender/attr 均为 base 的是时间分隔符，其余都按文本处理
+        extra_data={'message_type': 'time' if (sender == 'base' and attr == 'base') else 'text'},
+        hash=getattr(msg, 'hash', None)
+    )
+
+def _parse_dict_message(msg: Dict[str, Any], current_time: int) -> _ParsedMessage:
+    """解析字典消息，没有独立列的字段保留到extra_data"""
+    return _ParsedMessage(
+        content=msg.get('content', str(msg)),
+        is_self=msg.get('is_self', False),
+        timestamp=msg.get('timestamp', current_time),
+        sender=msg.get('sender', ''),
+        attr=msg.get('attr', ''),
+        original_time=msg.get('original_time', ''),
+        formatted_time=msg.get('time', ''),
+        msg_type=msg.get('msg_type', 'text'),
+        extra_data={k: v for k, v in msg.items() if k not in _DICT_MESSAGE_KNOWN_KEYS},
+        hash=None
+    )
+
+def _parse_text_message(content: str, current_time: int) -> _ParsedMessage:
+    """解析纯文本（或其他无法识别类型）的消息"""
+    return _ParsedMessage(content, False, current_time, '', '', '', '', 'text', {}, None)
+
+# 特殊消息的(sender, attr, type) -> (message_type, extra_data)，未命中时沿用消息自身的type
+_MESSAGE_TYPE_MAP = {
+    ('base', 'base', 'other'): ('time', EXTRA_TIME),  # 时间分隔符消息
+}
+
 # 尝试导入wxautox，如果失败则自动安装
 def try_import_wxautox():
     """尝试导入wxautox，如果失败则自动安装"""
@@ -125,18 +393,42 @@ if not WXAUTOX_AVAILABLE:
 class WxAutoBridge:
     def __init__(self):
         self.wechat_client = None
+        self._load_more_message = None  # 缓存的wxautox客户端方法，见_cache_client_methods
+        self._get_all_message = None
+        self._get_next_new_message = None
         self.is_connected = False
         self.monitored_contacts = {}
+        self._monitored_names = frozenset()  # monitored_contacts的键，修改字典后由_refresh_monitored_names重建
         self.auto_reply_enabled = False
         self.lock = threading.Lock()
         self.cached_user_info = {}  # 缓存用户信息
         self.current_wxid = None  # 当前用户的wxid
         self.message_queue = Queue()  # 消息处理队列
         self.message_processor_thread = None  # 消息处理线程
+        self._reply_queue = Queue()  # 待发送的自动回复：(消息, 回复内容, 回复消息ID)
+        self._reply_sender_thread = None  # 自动回复发送线程
         self.monitoring_thread = None  # 消息监听线程
         self.is_monitoring = False  # 是否正在监听
+        self._monitor_wake = threading.Event()  # 唤醒监听线程（启动/停止监听时立即生效）
+        self._methods_logged = False  # 是否已输出过微信客户端可用方法列表
+        self._dedup_salt = secrets.token_bytes(8)  # 监听去重用的随机盐，每次启动不同
+        # AI接口的HTTP会话，复用连接，避免每次请求重新握手
+        self._http = requests.Session()
+        http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self._http.mount('https://', http_adapter)
+        self._http.mount('http://', http_adapter)
         self.thread_pool = ThreadPoolExecutor(max_workers=3)  # 线程池用于处理消息
+        # 后台保存消息专用的单线程池：不与AI调用争抢线程，同时保证保存按提交顺序依次执行
+        self._save_pool = ThreadPoolExecutor(max_workers=1)
+        self._pending_saves = {}  # 联系人 -> 后台保存消息的Future
+        self._pending_saves_lock = threading.Lock()
         self.db_path = DB_PATH  # 保存数据库路径，而不是连接对象
+        self._db_local = threading.local()  # 每个线程缓存一个数据库连接
+        self._db_connections = {}  # 线程 -> 连接，用于清理
+        self._db_connections_lock = threading.Lock()
+        self._known_tables = set()  # 已确认存在的表，见_table_exists
+        self._table_columns = {}  # 表名 -> 列名列表，见_get_table_columns
+        self._ai_config_unique = False  # ai_sales_config是否已有wxid唯一索引，见_init_database
 
         # 初始化数据库
         self._init_database()
@@ -147,19 +439,90 @@ class WxAutoBridge:
         except Exception as e:
             logger.warning(f"清理旧的建议消息失败: {e}")
 
+    def _cache_client_methods(self):
+        """wechat_client变化后缓存常用的绑定方法，热路径上不再反复hasattr/getattr"""
+        client = self.wechat_client
+        self._load_more_message = getattr(client, 'LoadMoreMessage', None)
+        self._get_all_message = getattr(client, 'GetAllMessage', None)
+        self._get_next_new_message = getattr(client, 'GetNextNewMessage', None)
+
     def _get_db_connection(self):
-        """获取数据库连接，每个线程使用独立的连接"""
-        conn = sqlite3.connect(self.db_path)
+        """获取数据库连接，每个线程复用同一个长连接
+
+        调用方用 with conn: 管理事务（正常提交、异常回滚），不要关闭连接。
+        """
+        conn = getattr(self._db_local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        # WAL模式下synchronous=NORMAL只在checkpoint时fsync：
+        # 断电可能丢失最后一个已提交事务，但数据库文件不会损坏
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-65536")
+        self._db_local.conn = conn
+
+        with self._db_connections_lock:
+            # 顺便关闭已退出线程遗留的连接
+            for thread, stale_conn in list(self._db_connections.items()):
+                if not thread.is_alive():
+                    try:
+                        stale_conn.close()
+                    except Exception:
+                        pass
+                    del self._db_connections[thread]
+            self._db_connections[threading.current_thread()] = conn
         return conn
 
+    def _close_db_connections(self):
+        """关闭所有线程缓存的数据库连接"""
+        with self._db_connections_lock:
+            for conn in self._db_connections.values():
+                try:
+                    # 按SQLite建议，在长连接关闭前执行一次optimize
+                    conn.execute("PRAGMA optimize")
+                    conn.close()
+                except Exception:
+                    pass
+            self._db_connections.clear()
+
+    def _table_exists(self, cursor, table_name: str) -> bool:
+        """检查表是否存在，确认存在后缓存，不再查询sqlite_master"""
+        if table_name in self._known_tables:
+            return True
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+        if cursor.fetchone():
+            self._known_tables.add(table_name)
+            return True
+        return False
+
+    def _get_table_columns(self, cursor, table_name: str) -> List[str]:
+        """获取表的列名并缓存（表结构只在_init_database中变更）"""
+        columns = self._table_columns.get(table_name)
+        if columns is None:
+            cursor.execute(f"PRAGMA table_info({table_name})")
+            columns = [column[1] for column in cursor.fetchall()]
+            self._table_columns[table_name] = columns
+        return columns
+
     def _init_database(self):
         """初始化数据库"""
+        # 表结构可能被迁移，清空缓存
+        self._known_tables.clear()
+        self._table_columns.clear()
         try:
             # 创建数据库连接
             conn = self._get_db_connection()
             cursor = conn.cursor()
 
+            # 启用WAL日志模式（持久化在数据库文件中，只需设置一次）
+            journal_mode = cursor.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            if str(journal_mode).lower() != "wal":
+                logger.warning(f"⚠️ 无法启用WAL模式，当前journal_mode: {journal_mode}")
+
             # 创建contacts表
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS contacts (
@@ -233,6 +596,27 @@ class WxAutoBridge:
                 cursor.execute("ALTER TABLE messages ADD COLUMN formatted_time TEXT")
                 logger.info("✅ 成功添加formatted_time字段")
 
+            # 会话内按id倒序分页使用的索引（keyset分页：id < before_id）
+            cursor.execute(SQL_CREATE_MESSAGES_SESSION_INDEX)
+            cursor.execute(SQL_CREATE_MESSAGES_TIMESTAMP_INDEX)
+
+            # 同一会话中按hash去重的唯一索引。已有重复消息时不创建，也不删除用户的历史消息，
+            # 此时写入不按hash去重，待重复消息被清理后下次启动时再创建
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_messages_session_hash'")
+            if not cursor.fetchone():
+                cursor.execute('''
+                    SELECT 1 FROM messages WHERE hash IS NOT NULL
+                    GROUP BY session_id, wxid, hash HAVING COUNT(*) > 1
+                    LIMIT 1
+                    ''')
+                if cursor.fetchone():
+                    logger.warning("messages表中存在hash重复的消息，跳过创建唯一索引ux_messages_session_hash")
+                else:
+                    cursor.execute('''
+                        CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_session_hash
+                        ON messages(session_id, wxid, hash) WHERE hash IS NOT NULL
+                        ''')
+
             # 创建sessions表，增加is_monitoring字段
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS sessions (
@@ -272,28 +656,83 @@ class WxAutoBridge:
                     max_tokens INTEGER,
                     system_prompt TEXT,
                     created_at TEXT,
-                    updated_at TEXT
+                    updated_at TEXT,
+                    model_name TEXT,
+                    auto_reply_prompt TEXT,
+                    reply_suggest_prompt TEXT,
+                    auto_reply_enabled INTEGER DEFAULT 0,
+                    reply_suggest_enabled INTEGER DEFAULT 0
                 )
                 ''')
 
+            # 检查ai_sales_config表结构，补齐后来新增的字段
+            cursor.execute("PRAGMA table_info(ai_sales_config)")
+            ai_config_columns = [column[1] for column in cursor.fetchall()]
+            for column, column_type in (
+                ("model_name", "TEXT"),
+                ("auto_reply_prompt", "TEXT"),
+                ("reply_suggest_prompt", "TEXT"),
+                ("auto_reply_enabled", "INTEGER DEFAULT 0"),
+                ("reply_suggest_enabled", "INTEGER DEFAULT 0"),
+            ):
+                if column not in ai_config_columns:
+                    logger.info(f"正在添加{column}字段到ai_sales_config表...")
+                    cursor.execute(f"ALTER TABLE ai_sales_config ADD COLUMN {column} {column_type}")
+                    logger.info(f"✅ 成功添加{column}字段")
+
+            # 每个wxid一条配置的唯一索引（UPSERT的冲突目标）。已有重复配置时不创建，也不删除用户的配置，
+            # 此时写入配置改为先更新、没有命中再插入，见_upsert_ai_sales_config
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_ai_sales_config_wxid'")
+            self._ai_config_unique = cursor.fetchone() is not None
+            if not self._ai_config_unique:
+                cursor.execute('SELECT 1 FROM ai_sales_config GROUP BY wxid HAVING COUNT(*) > 1 LIMIT 1')
+                if cursor.fetchone():
+                    logger.warning("ai_sales_config表中存在同一wxid的多条配置，跳过创建唯一索引ux_ai_sales_config_wxid")
+                else:
+                    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_ai_sales_config_wxid ON ai_sales_config(wxid)")
+                    self._ai_config_unique = True
+
             # 创建reply_suggestions表
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS reply_suggestions (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     session_id TEXT NOT NULL,
-                    message_id INTEGER NOT NULL,
+                    wxid TEXT NOT NULL,
                     content TEXT NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    created_at TEXT,
                     used INTEGER DEFAULT 0,
-                    created_at TEXT NOT NULL
+                    chat_name TEXT NOT NULL,
+                    FOREIGN KEY (message_id) REFERENCES messages (id)
                 )
                 ''')
 
+            # 旧版本创建的reply_suggestions表缺少wxid、timestamp、chat_name字段
+            cursor.execute("PRAGMA table_info(reply_suggestions)")
+            suggestion_columns = [column[1] for column in cursor.fetchall()]
+            for column, column_type in (
+                ("wxid", "TEXT NOT NULL DEFAULT ''"),
+                ("timestamp", "INTEGER NOT NULL DEFAULT 0"),
+                ("chat_name", "TEXT NOT NULL DEFAULT ''"),
+            ):
+                if column not in suggestion_columns:
+                    logger.info(f"正在添加{column}字段到reply_suggestions表...")
+                    cursor.execute(f"ALTER TABLE reply_suggestions ADD COLUMN {column} {column_type}")
+                    logger.info(f"✅ 成功添加{column}字段")
+
+            # 按会话查询最新建议使用的索引
+            cursor.execute(SQL_CREATE_REPLY_SUGGESTIONS_INDEX)
+
             conn.commit()
-            conn.close()
         except sqlite3.Error as e:
             logger.error(f"数据库初始化错误: {e}")
             # 继续执行，不要因为数据库错误而终止程序
 
+    def _refresh_monitored_names(self):
+        """监听联系人变化后重建名单快照，监听线程直接读取该不可变集合"""
+        self._monitored_names = frozenset(self.monitored_contacts)
+
     def set_current_wxid(self, wxid: str):
         """设置当前用户的wxid"""
         global CURRENT_WXID
@@ -302,7 +741,7 @@ class WxAutoBridge:
         logger.info(f"Set current user wxid: {wxid}")
 
     def get_current_wxid(self) -> str:
-        """获取当前用户的wxid"""
+        """获取当前用户的wxid（登录时由set_current_wxid写入内存，读取时不访问数据库或微信客户端）"""
         return self.current_wxid or CURRENT_WXID or "default_user"
 
     def _save_message_to_db(self, session_id: str, content: str, message_type: str, 
@@ -312,20 +751,19 @@ class WxAutoBridge:
         try:
             current_wxid = self.get_current_wxid()
             timestamp = int(time.time())
-            extra_data = json.dumps(extra) if extra else None
+            extra_data = _dump_extra_data(extra)
             is_self = 1 if sender_type == 'self' else 0
             msg_type = message_type or ''
             attr = sender_type or ''
             msg_id = 0  # 初始化消息ID
-            created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            created_at = _format_timestamp(timestamp)
             
             # 使用新的数据库连接
             with self._get_db_connection() as conn:
                 cursor = conn.cursor()
                 
                 # 检查表结构
-                cursor.execute("PRAGMA table_info(messages)")
-                columns = [column[1] for column in cursor.fetchall()]
+                columns = self._get_table_columns(cursor, "messages")
                     
                 # 构建动态SQL语句和参数
                 fields = ["session_id", "wxid", "content", "is_self", "timestamp", "msg_type", "sender", "attr"]
@@ -353,8 +791,8 @@ class WxAutoBridge:
                     fields.append("status")
                     values.append(status)
                 
-                # 构建SQL语句
-                sql = f"INSERT INTO messages ({', '.join(fields)}) VALUES ({', '.join(['?'] * len(fields))})"
+                # 构建SQL语句（同一会话中hash已存在时忽略，见ux_messages_session_hash）
+                sql = f"INSERT OR IGNORE INTO messages ({', '.join(fields)}) VALUES ({', '.join(['?'] * len(fields))})"
                 logger.debug(f"执行SQL: {sql}")
                 logger.debug(f"参数: {values}")
                 
@@ -362,159 +800,92 @@ class WxAutoBridge:
                 cursor.execute(sql, values)
                 conn.commit()
                 
-                # 获取最后插入的消息ID
-                cursor.execute("SELECT last_insert_rowid()")
-                msg_id = cursor.fetchone()[0]
-                logger.debug(f"获取到新保存消息的ID: {msg_id}")
+                if cursor.rowcount:
+                    # 获取新插入的消息ID
+                    msg_id = cursor.lastrowid
+                    logger.debug(f"获取到新保存消息的ID: {msg_id}")
+                else:
+                    # 消息已存在，返回已有消息的ID
+                    cursor.execute(
+                        "SELECT id FROM messages WHERE session_id = ? AND wxid = ? AND hash = ? ORDER BY id LIMIT 1",
+                        (session_id, current_wxid, hash))
+                    row = cursor.fetchone()
+                    msg_id = row[0] if row else 0
+                    logger.debug(f"消息已存在，使用已有消息ID: {msg_id}")
                 
             return True, msg_id
         except Exception as e:
-            logger.error(f"保存消息失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("保存消息失败: %s", e)
             return False, 0
 
+    def _start_reply_sender(self):
+        """启动自动回复发送线程：回复保存后立即入队，由这一个线程依次调用message.reply"""
+        if self._reply_sender_thread and self._reply_sender_thread.is_alive():
+            return
+
+        def send_replies():
+            while True:
+                item = self._reply_queue.get()
+                if item is None:
+                    break
+                message, reply, reply_msg_id = item
+                try:
+                    logger.info(f"📤 自动回复模式：发送回复 '{reply[:50]}...'")
+                    message.reply(reply)
+                except Exception as e:
+                    logger.exception("❌ 发送自动回复失败: %s", e)
+                    try:
+                        self._delete_message(reply_msg_id)
+                    except Exception as e:
+                        logger.exception("❌ 删除发送失败的回复出错: %s", e)
+            logger.info("🛑 自动回复发送线程已停止")
+
+        self._reply_sender_thread = threading.Thread(target=send_replies, daemon=True)
+        self._reply_sender_thread.start()
+
     def _start_message_processor(self):
         """启动消息处理线程"""
+        self._start_reply_sender()
         def process_messages():
             logger.info("🚀 消息处理线程已启动")
             message_count = 0
             
             while True:
-                item = None
                 try:
-                    # 从队列获取消息
+                    # 从队列获取一批消息，并一次取出队列中已积压的其它批次
                     logger.debug("⏳ 消息处理线程等待新消息...")
-                    item = self.message_queue.get(block=True, timeout=60)  # 设置超时，避免永久阻塞
-                    
-                    # 检查是否为退出信号
-                    if item is None:
-                        logger.info("🛑 收到退出信号，消息处理线程准备退出")
-                        # 标记任务完成
-                        self.message_queue.task_done()
-                        break
-                        
-                    message_count += 1
-                    contact_name, message = item
-                    
-                    logger.info(f"📩 处理第{message_count}条消息，来自: {contact_name}")
-                    
-                    # 跳过不存在的联系人
-                    if contact_name not in self.monitored_contacts:
-                        logger.warning(f"⚠️ 联系人 {contact_name} 不在监听列表中，跳过处理")
-                        self.message_queue.task_done()
-                        continue
-                    
-                    # 获取监听配置
-                    config = self.monitored_contacts[contact_name]
-                    logger.debug(f"⚙️ 联系人 {contact_name} 的监听配置: {config}")
-                    
-                    # 保存接收到的消息
-                    session_id = f"private_self_{contact_name}"
-                    message_type = getattr(message, 'type', 'text')
-                    sender = getattr(message, 'sender', contact_name)
-                    sender_type = message.attr if hasattr(message, 'attr') else 'unknown'
-                    content = getattr(message, 'content', '')
-                    # 获取消息hash值
-                    msg_hash = getattr(message, 'hash', None)
-                    # 获取消息的info属性
-                    msg_info = getattr(message, 'info', {})
-                    
-                    logger.info(f"💬 消息内容: '{content[:50]}...' (类型: {message_type}, hash: {msg_hash})")
-                    # 将info字典内容完整展示在日志中
-                    logger.info(f"📋 消息info详情: {json.dumps(msg_info, ensure_ascii=False, indent=2)}")
-                    
-                    # 构建extra信息
-                    extra = {"message_type": message_type}
-                    
-                    # 保存消息到数据库
-                    logger.debug(f"💾 保存消息到数据库: {session_id}")
-                    save_result, received_msg_id = self._save_message_to_db(
-                        session_id=session_id,
-                        content=content,
-                        message_type=message_type,
-                        sender=sender,
-                        sender_type=sender_type,
-                        extra=extra,
-                        hash=msg_hash
-                    )
-                    
-                    if save_result:
-                        logger.info(f"✅ 消息已保存到数据库，ID: {received_msg_id}，结果: {save_result}")
-                    else:
-                        logger.warning("⚠️ 消息保存失败")
-                    
-                    # 获取AI配置
-                    logger.debug("🔍 获取AI配置...")
-                    ai_config = self.get_ai_sales_config()
-                    if not ai_config["success"]:
-                        logger.warning("⚠️ 获取AI配置失败，跳过后续处理")
-                        self.message_queue.task_done()
-                        continue
-                        
-                    ai_data = ai_config["data"]
-                    logger.info(f"⚙️ AI配置: {ai_data}")
-                    
-                    try:
-                        logger.info("🤖 生成自动回复内容...")
-                        # 生成回复内容
-                        reply = self._handle_auto_reply(contact_name, message)
-                        if reply:
-                            # 直接根据ai_sales_config表中的auto_reply_enabled值判断
-                            if ai_data.get("auto_reply_enabled"):
-                                # 自动回复模式：直接发送
-                                logger.info(f"📤 自动回复模式：发送回复 '{reply[:50]}...'")
-                                message.reply(reply)
-                                
-                                # 保存发送的回复消息
-                                logger.info(f"💾 保存自动回复消息到数据库，回复消息ID: {received_msg_id}")
-                                self._save_message_to_db(
-                                    session_id=session_id,
-                                    content=reply,
-                                    message_type="text",
-                                    sender="self",
-                                    sender_type="self",
-                                    reply_to=received_msg_id,  # 使用接收到的消息ID
-                                    status=1,
-                                    extra={"message_type": "text", "is_reply": True, "reply_to_id": received_msg_id}
-                                )
-                            else:
-                                # 回复建议模式：保存为建议到新表
-                                logger.info(f"💡 回复建议模式：保存回复建议 '{reply[:50]}...'")
-                                # 使用新方法保存回复建议
-                                save_result = self._save_reply_suggestion(
-                                    session_id=session_id,
-                                    content=reply,
-                                    message_id=received_msg_id,  # 使用接收到的消息ID
-                                    contact_name=contact_name
-                                )
-                                if save_result:
-                                    logger.info("✅ 回复建议已保存到reply_suggestions表")
-                                else:
-                                    logger.warning("⚠️ 回复建议保存失败")
-                        else:
-                            logger.warning("⚠️ 未生成回复内容")
-                    except Exception as e:
-                        logger.error(f"❌ 处理回复失败: {e}")
-                        logger.error(traceback.format_exc())
-
+                    batches = [self.message_queue.get(block=True, timeout=60)]  # 设置超时，避免永久阻塞
+                    while batches[-1] is not None:
+                        try:
+                            batches.append(self.message_queue.get_nowait())
+                        except Empty:
+                            break
                 except Empty:
                     # 队列超时，继续等待
                     logger.debug("⏱️ 消息队列等待超时，继续监听...")
                     continue
+
+                # 检查是否为退出信号（先处理完退出信号之前的消息）
+                stop = batches[-1] is None
+                if stop:
+                    batches.pop()
+
+                items = [item for batch in batches for item in batch]
+                try:
+                    if items:
+                        self._process_incoming_messages(items, message_count + 1)
+                        message_count += len(items)
                 except Exception as e:
-                    logger.error(f"❌ 消息处理失败: {e}")
-                    logger.error(traceback.format_exc())
-                    # 确保在发生异常时也标记任务完成
-                    if item is not None:
-                        try:
-                            self.message_queue.task_done()
-                        except ValueError:
-                            logger.warning("⚠️ 任务已经被标记为完成")
-                        except Exception as e2:
-                            logger.error(f"标记任务完成时出错: {e2}")
+                    logger.exception("❌ 处理消息时出错: %s", e)
                 finally:
-                    # 确保在任何情况下都正确处理队列
-                    pass
+                    # 标记任务完成
+                    for _ in batches:
+                        self.message_queue.task_done()
+
+                if stop:
+                    logger.info("🛑 收到退出信号，消息处理线程准备退出")
+                    self.message_queue.task_done()
+                    break
             
             logger.info("🛑 消息处理线程已停止")
                     
@@ -537,6 +908,144 @@ class WxAutoBridge:
         # 返回线程ID，便于调试
         return self.message_processor_thread.ident
 
+    def _process_incoming_messages(self, items: List[tuple], first_count: int):
+        """处理一批(联系人, 消息)
+
+        每个联系人一个线程池任务，逐条保存消息、生成回复、保存回复或回复建议，
+        保证生成下一条回复时的聊天历史已包含前面的消息和回复；多个联系人之间并发调用AI接口。
+        需要自动发送的回复保存后立即交给自动回复发送线程（wxautox调用不放到线程池中）。
+        """
+        by_contact = {}
+        for n, (contact_name, message) in enumerate(items):
+            by_contact.setdefault(contact_name, []).append((first_count + n, message))
+
+        if len(by_contact) == 1:
+            for name, entries in by_contact.items():
+                self._handle_contact_messages(name, entries)
+        else:
+            futures = [self.thread_pool.submit(self._handle_contact_messages, name, entries)
+                       for name, entries in by_contact.items()]
+            for future in futures:
+                future.result()
+
+    def _handle_contact_messages(self, contact_name: str, entries: List[tuple]):
+        """按顺序处理同一联系人的(序号, 消息)，需要自动发送的回复保存后立即放入发送队列"""
+        for message_count, message in entries:
+            try:
+                received = self._receive_incoming_message(contact_name, message, message_count)
+                if received is None:
+                    continue
+                logger.info("🤖 生成自动回复内容...")
+                reply = self._handle_auto_reply(contact_name, message)
+                reply_msg_id = self._store_reply(contact_name, reply, *received)
+                if reply_msg_id is not None:
+                    self._reply_queue.put((message, reply, reply_msg_id))
+            except Exception as e:
+                logger.exception("❌ 消息处理失败: %s", e)
+
+    def _receive_incoming_message(self, contact_name: str, message: Any, message_count: int) -> Optional[tuple]:
+        """保存收到的消息并读取AI配置，返回(session_id, 消息ID, AI配置)，无需继续处理时返回None"""
+        logger.info(f"📩 处理第{message_count}条消息，来自: {contact_name}")
+
+        # 跳过不存在的联系人
+        if contact_name not in self.monitored_contacts:
+            logger.warning(f"⚠️ 联系人 {contact_name} 不在监听列表中，跳过处理")
+            return
+
+        # 获取监听配置
+        config = self.monitored_contacts[contact_name]
+        logger.debug(f"⚙️ 联系人 {contact_name} 的监听配置: {config}")
+
+        # 保存接收到的消息
+        session_id = _private_session_id(contact_name)
+        message_type = getattr(message, 'type', 'text')
+        sender = getattr(message, 'sender', contact_name)
+        sender_type = message.attr if hasattr(message, 'attr') else 'unknown'
+        content = getattr(message, 'content', '')
+        # 获取消息hash值
+        msg_hash = getattr(message, 'hash', None)
+        # 获取消息的info属性
+        msg_info = getattr(message, 'info', {})
+
+        logger.info(f"💬 消息内容: '{content[:50]}...' (类型: {message_type}, hash: {msg_hash})")
+        # 将info字典内容完整展示在日志中
+        logger.info(f"📋 消息info详情: {json.dumps(msg_info, ensure_ascii=False, indent=2)}")
+
+        # 构建extra信息
+        extra = {"message_type": message_type}
+
+        # 保存消息到数据库
+        logger.debug(f"💾 保存消息到数据库: {session_id}")
+        save_result, received_msg_id = self._save_message_to_db(
+            session_id=session_id,
+            content=content,
+            message_type=message_type,
+            sender=sender,
+            sender_type=sender_type,
+            extra=extra,
+            hash=msg_hash
+        )
+
+        if save_result:
+            logger.info(f"✅ 消息已保存到数据库，ID: {received_msg_id}，结果: {save_result}")
+        else:
+            logger.warning("⚠️ 消息保存失败")
+
+        # 获取AI配置
+        logger.debug("🔍 获取AI配置...")
+        ai_config = self.get_ai_sales_config()
+        if not ai_config["success"]:
+            logger.warning("⚠️ 获取AI配置失败，跳过后续处理")
+            return
+
+        ai_data = ai_config["data"]
+        logger.info(f"⚙️ AI配置: {ai_data}")
+        return session_id, received_msg_id, ai_data
+
+    def _store_reply(self, contact_name: str, reply: Optional[str],
+                     session_id: str, received_msg_id: int, ai_data: Dict[str, Any]) -> Optional[int]:
+        """保存生成的回复：自动回复模式下保存为待发送消息并返回其ID，回复建议模式下保存建议并返回None"""
+        if not reply:
+            logger.warning("⚠️ 未生成回复内容")
+            return None
+
+        # 直接根据ai_sales_config表中的auto_reply_enabled值判断
+        if ai_data.get("auto_reply_enabled"):
+            # 自动回复模式：先保存，之后的消息生成回复时聊天历史中就有这条回复；发送失败时再删除
+            logger.info(f"💾 保存自动回复消息到数据库，回复消息ID: {received_msg_id}")
+            save_result, reply_msg_id = self._save_message_to_db(
+                session_id=session_id,
+                content=reply,
+                message_type="text",
+                sender="self",
+                sender_type="self",
+                reply_to=received_msg_id,  # 使用接收到的消息ID
+                status=1,
+                extra={"message_type": "text", "is_reply": True, "reply_to_id": received_msg_id}
+            )
+            return reply_msg_id
+
+        # 回复建议模式：保存为建议到新表
+        logger.info(f"💡 回复建议模式：保存回复建议 '{reply[:50]}...'")
+        save_result = self._save_reply_suggestion(
+            session_id=session_id,
+            content=reply,
+            message_id=received_msg_id,  # 使用接收到的消息ID
+            contact_name=contact_name
+        )
+        if save_result:
+            logger.info("✅ 回复建议已保存到reply_suggestions表")
+        else:
+            logger.warning("⚠️ 回复建议保存失败")
+        return None
+
+    def _delete_message(self, msg_id: int):
+        """删除一条消息（自动回复发送失败时撤销已保存的回复）"""
+        if not msg_id:
+            return
+        with self._get_db_connection() as conn:
+            conn.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
+
     def _handle_auto_reply(self, contact_name: str, message: Any):
         """处理自动回复"""
         try:
@@ -562,7 +1071,7 @@ class WxAutoBridge:
             system_prompt = ai_data.get("system_prompt") or "你是一个专业的销售助手，负责回复客户的消息。请根据客户的消息提供有帮助的回复。"
             
             # 获取历史聊天记录
-            session_id = f"private_self_{contact_name}"
+            session_id = _private_session_id(contact_name)
             chat_history = self._get_chat_history(session_id, limit=10)
             
             # 准备消息列表，包含历史聊天记录
@@ -609,8 +1118,7 @@ class WxAutoBridge:
                 return f"自动回复: 收到您的消息 - {content}"
             
         except Exception as e:
-            logger.error(f"自动回复处理失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("自动回复处理失败: %s", e)
             return f"自动回复: 收到您的消息 - {content}"
             
     def _get_chat_history(self, session_id: str, limit: int = 10) -> List[Dict[str, Any]]:
@@ -633,7 +1141,7 @@ class WxAutoBridge:
                     SELECT content, is_self, timestamp 
                     FROM messages 
                     WHERE session_id = ? AND wxid = ? 
-                    ORDER BY timestamp DESC 
+                    ORDER BY timestamp DESC, id DESC
                     LIMIT ?
                 ''', (session_id, current_wxid, limit))
                 
@@ -652,8 +1160,7 @@ class WxAutoBridge:
                 return messages
                 
         except Exception as e:
-            logger.error(f"获取聊天历史记录失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("获取聊天历史记录失败: %s", e)
             return []
             
     def call_openai_api(self, api_key: str, model: str, system_prompt: str, user_prompt: str, 
@@ -678,17 +1185,14 @@ class WxAutoBridge:
                 url = api_url
             else:
                 # 默认使用国内可访问的代理地址
-                url = "https://api.openai-proxy.com/v1/chat/completions"
+                url = DEFAULT_API_URL
                 # 其他可选的代理地址
                 # url = "https://openai.aihey.cc/openai/v1/chat/completions"
                 # url = "https://openai.wndbac.cn/v1/chat/completions"
                 # url = "https://proxy.geekai.co/v1/chat/completions"
             
             # 准备请求头
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
+            headers = _auth_headers(api_key)
             
             # 准备请求体
             data = {
@@ -704,11 +1208,11 @@ class WxAutoBridge:
             logger.info(f"开始调用API: {url}")
             
             # 发送请求
-            response = requests.post(url, headers=headers, json=data, timeout=30)
+            response = self._http.post(url, headers=headers, data=_json_dumps_bytes(data), timeout=30)
             
             # 检查响应状态
             if response.status_code == 200:
-                response_data = response.json()
+                response_data = _json_loads(response.content)
                 
                 # 提取生成的文本
                 if "choices" in response_data and len(response_data["choices"]) > 0:
@@ -725,18 +1229,19 @@ class WxAutoBridge:
                     logger.warning(f"API响应格式不正确: {response_data}")
                     return None
             else:
-                logger.error(f"API调用失败，状态码: {response.status_code}, 响应: {response.text}")
+                # 只记录响应开头部分，避免解码和输出整个错误页面
+                logger.error("API调用失败，状态码: %s, 响应: %s",
+                             response.status_code, response.content[:200].decode('utf-8', 'replace'))
                 # 如果当前API调用失败，尝试使用备用API
-                if url != "https://api.openai.com/v1/chat/completions":
+                if url != OFFICIAL_API_URL:
                     logger.info("尝试使用官方API进行调用")
                     return self._fallback_api_call(api_key, model, system_prompt, user_prompt, temperature, max_tokens)
                 return None
                 
         except Exception as e:
-            logger.error(f"调用OpenAI API失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("调用OpenAI API失败: %s", e)
             # 如果当前API调用出现异常，尝试使用备用API
-            if url != "https://api.openai.com/v1/chat/completions":
+            if url != OFFICIAL_API_URL:
                 logger.info("尝试使用官方API进行调用")
                 return self._fallback_api_call(api_key, model, system_prompt, user_prompt, temperature, max_tokens)
             return None
@@ -752,60 +1257,80 @@ class WxAutoBridge:
             生成的回复内容，如果调用失败则返回None
         """
         try:
-            # 备用API列表
-            backup_apis = [
-                "https://api.openai.com/v1/chat/completions",
-                "https://openai.wndbac.cn/v1/chat/completions",
-                "https://proxy.geekai.co/v1/chat/completions"
-            ]
-            
-            for url in backup_apis:
-                try:
-                    logger.info(f"尝试使用备用API: {url}")
-                    
-                    # 准备请求头
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {api_key}"
-                    }
-                    
-                    # 准备请求体
-                    data = {
-                        "model": model,
-                        "messages": [
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                        "temperature": temperature,
-                        "max_tokens": max_tokens
-                    }
-                    
-                    # 发送请求
-                    response = requests.post(url, headers=headers, json=data, timeout=30)
-                    
-                    # 检查响应状态
-                    if response.status_code == 200:
-                        response_data = response.json()
-                        
-                        # 提取生成的文本
-                        if "choices" in response_data and len(response_data["choices"]) > 0:
-                            message = response_data["choices"][0].get("message", {})
-                            content = message.get("content", "")
-                            
-                            if content:
-                                logger.info(f"备用API调用成功: {url}")
-                                return content.strip()
-                except Exception as e:
-                    logger.warning(f"备用API {url} 调用失败: {e}")
-                    continue
+            # 请求头和请求体对所有备用API相同，只构建一次
+            headers = _auth_headers(api_key)
+            body = _json_dumps_bytes({
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                "temperature": temperature,
+                "max_tokens": max_tokens
+            })
             
-            logger.error("所有API调用尝试均失败")
-            return None
+            return self._race_fallback_apis(headers, body)
         except Exception as e:
-            logger.error(f"备用API调用失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("备用API调用失败: %s", e)
             return None
 
+    def _race_fallback_apis(self, headers: Dict[str, str], body: bytes) -> Optional[str]:
+        """按顺序请求备用API，返回最先成功的回复内容，全部失败时返回None
+
+        前一个备用API失败，或超过FALLBACK_API_HEDGE_DELAY秒仍未返回时，才请求下一个，
+        避免把API密钥和聊天记录同时发给所有地址，也避免一次回复被多个接口重复计费。
+        使用单独的临时线程池：本方法可能在self.thread_pool的任务中被调用，不能再向同一个线程池提交并等待。
+        """
+        executor = ThreadPoolExecutor(max_workers=len(_FALLBACK_API_URLS), thread_name_prefix="fallback_api")
+        remaining_urls = iter(_FALLBACK_API_URLS)
+        pending = set()
+        try:
+            while True:
+                url = next(remaining_urls, None)
+                if url is not None:
+                    pending.add(executor.submit(self._post_fallback_api, url, headers, body))
+                if not pending:
+                    break
+                # 还有未请求的备用API时只等待一段时间，之后同时等待已发出的请求
+                done, pending = wait(pending, timeout=FALLBACK_API_HEDGE_DELAY if url is not None else None,
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    content = future.result()
+                    if content:
+                        return content
+        finally:
+            # 已有结果时不等待其余请求结束
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        logger.error("所有API调用尝试均失败")
+        return None
+
+    def _post_fallback_api(self, url: str, headers: Dict[str, str], body: bytes) -> Optional[str]:
+        """请求一个备用API，成功时返回回复内容，失败返回None"""
+        try:
+            logger.info(f"尝试使用备用API: {url}")
+            
+            # 发送请求
+            response = self._http.post(url, headers=headers, data=body, timeout=30)
+            
+            # 检查响应状态
+            if response.status_code == 200:
+                response_data = _json_loads(response.content)
+                
+                # 提取生成的文本
+                if "choices" in response_data and len(response_data["choices"]) > 0:
+                    message = response_data["choices"][0].get("message", {})
+                    content = message.get("content", "")
+                    
+                    if content:
+                        logger.info(f"备用API调用成功: {url}")
+                        return content.strip()
+            else:
+                logger.warning(f"备用API {url} 调用失败，状态码: {response.status_code}")
+        except Exception as e:
+            logger.warning(f"备用API {url} 调用失败: {e}")
+        return None
+
     def init(self) -> Dict[str, Any]:
         """初始化微信客户端（API接口）"""
         return self.init_wechat()
@@ -880,6 +1405,7 @@ class WxAutoBridge:
             # 未连接时，初始化
             pythoncom.CoInitialize()
             self.wechat_client = WeChat()
+            self._cache_client_methods()
             self.is_connected = True
             # 立即获取并缓存用户信息
             nickname, wxid = "Unknown", ""
@@ -1009,6 +1535,7 @@ class WxAutoBridge:
         try:
             # 重置连接状态
             self.wechat_client = None
+            self._cache_client_methods()
             self.is_connected = False
             self.cached_user_info = {}
 
@@ -1222,7 +1749,7 @@ class WxAutoBridge:
             saved_count = 0
 
             # 创建新的数据库连接
-            with sqlite3.connect(DB_PATH) as conn:
+            with self._get_db_connection() as conn:
                 cursor = conn.cursor()
 
                 for contact in contacts:
@@ -1333,7 +1860,7 @@ class WxAutoBridge:
             current_wxid = self.get_current_wxid()
             logger.info(f"使用当前用户wxid: {current_wxid}")
             db_contacts = []
-            with sqlite3.connect(DB_PATH) as conn:
+            with self._get_db_connection() as conn:
                 cursor = conn.cursor()
                 try:
                     # 尝试关联查询获取监听状态
@@ -1341,10 +1868,10 @@ class WxAutoBridge:
                     SELECT c.id, c.name, c.type, c.remark, c.avatar, c.source, c.created_at, c.updated_at, 
                            CASE WHEN s.is_monitoring IS NULL THEN 0 ELSE s.is_monitoring END as is_monitoring
                     FROM contacts c
-                    LEFT JOIN sessions s ON s.session_id = ('private_self_' || c.name) AND s.wxid = c.wxid
+                    LEFT JOIN sessions s ON s.session_id = (? || c.name) AND s.wxid = c.wxid
                     WHERE c.wxid = ?
                     ORDER BY c.updated_at DESC
-                    ''', (current_wxid,))
+                    ''', (PRIVATE_SESSION_PREFIX, current_wxid))
                     has_is_monitoring = True
                 except Exception as e:
                     logger.error(f"关联查询失败: {e}")
@@ -1403,8 +1930,7 @@ class WxAutoBridge:
                 "message": f"成功获取 {len(db_contacts)} 个联系人 ({len(friends)} 个好友, {len(groups)} 个群组)"
             }
         except Exception as e:
-            logger.error(f"获取联系人列表失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("获取联系人列表失败: %s", e)
             return {"success": False, "message": str(e)}
 
     def _sort_contacts_by_wxautox_order(self, contacts: List[Dict[str, Any]], wxautox_order: List[str]) -> List[Dict[str, Any]]:
@@ -1757,7 +2283,7 @@ class WxAutoBridge:
             logger.info(f"✅ 消息已发送: {contact_name}")
             
             # 保存发送的消息到数据库
-            session_id = f"private_self_{contact_name}"
+            session_id = _private_session_id(contact_name)
             self._save_message_to_db(
                 session_id=session_id,
                 content=message,
@@ -1770,8 +2296,7 @@ class WxAutoBridge:
             
             return {"success": True, "message": "消息已发送"}
         except Exception as e:
-            logger.error(f"❌ 发送消息失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("❌ 发送消息失败: %s", e)
             return {"success": False, "message": str(e)}
     
     def bulk_send(self, contacts: List[str], message: str, delay_range: Optional[List[int]] = None) -> Dict[str, Any]:
@@ -1810,7 +2335,7 @@ class WxAutoBridge:
     def get_message_history(self, contact_name: str, force_refresh: bool = False, page: int = 1, per_page: int = 50) -> Dict[str, Any]:
         """获取消息历史"""
         try:
-            session_id = f"private_self_{contact_name}"
+            session_id = _private_session_id(contact_name)
             current_wxid = self.get_current_wxid()
             # 从数据库获取消息
             with self._get_db_connection() as conn:
@@ -1818,7 +2343,7 @@ class WxAutoBridge:
                 cursor.execute('''
                     SELECT * FROM messages 
                     WHERE session_id = ? AND wxid = ?
-                    ORDER BY timestamp DESC
+                    ORDER BY timestamp DESC, id DESC
                     LIMIT ? OFFSET ?
                 ''', (session_id, current_wxid, per_page, (page - 1) * per_page))
                 
@@ -1841,27 +2366,9 @@ class WxAutoBridge:
                 
                 total = cursor.fetchone()[0]
                 
-                # 获取相关的回复建议
-                cursor.execute('''
-                    SELECT rs.id, rs.content, rs.message_id, rs.timestamp, rs.created_at, rs.used
-                    FROM reply_suggestions rs
-                    JOIN messages m ON rs.message_id = m.id
-                    WHERE rs.session_id = ? AND rs.wxid = ?
-                    ORDER BY rs.timestamp DESC
-                ''', (session_id, current_wxid))
-                
-                suggestions = []
-                for row in cursor.fetchall():
-                    suggestion = {
-                        "id": row[0],
-                        "content": row[1],
-                        "message_id": row[2],
-                        "timestamp": row[3],
-                        "created_at": row[4],
-                        "used": bool(row[5]),
-                        "formatted_time": datetime.fromtimestamp(row[3]).strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                    suggestions.append(suggestion)
+                # 获取本页消息相关的回复建议
+                suggestions = self._query_page_suggestions(
+                    cursor, session_id, current_wxid, [m["id"] for m in messages])
                 
                 return {
                     "success": True,
@@ -1876,8 +2383,7 @@ class WxAutoBridge:
                     }
                 }
         except Exception as e:
-            logger.error(f"❌ 获取消息历史失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("❌ 获取消息历史失败: %s", e)
             return {"success": False, "message": str(e)}
 
     def _get_messages_from_db(self, session_id: str, limit: int = None) -> List[Dict[str, Any]]:
@@ -1889,13 +2395,14 @@ class WxAutoBridge:
         """
         try:
             current_wxid = self.get_current_wxid()
-            with sqlite3.connect(DB_PATH) as conn:
+            with self._get_db_connection() as conn:
                 cursor = conn.cursor()
 
                 # 只查询必要的字段，减少数据传输量
                 if limit:
                     cursor.execute('''
-                    SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data
+                    SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data,
+                           strftime('%Y-%m-%d %H:%M:%S', timestamp, 'unixepoch', 'localtime') AS time
                     FROM messages
                     WHERE session_id = ? AND wxid = ?
                     ORDER BY id DESC
@@ -1903,7 +2410,8 @@ class WxAutoBridge:
                     ''', (session_id, current_wxid, limit))
                 else:
                     cursor.execute('''
-                    SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data
+                    SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data,
+                           strftime('%Y-%m-%d %H:%M:%S', timestamp, 'unixepoch', 'localtime') AS time
                     FROM messages
                     WHERE session_id = ? AND wxid = ?
                     ORDER BY id DESC
@@ -1913,19 +2421,19 @@ class WxAutoBridge:
                 messages = []
 
                 for row in rows:
-                    msg_id, content, is_self, timestamp, msg_type, sender, attr, extra_data = row
                     message = {
-                        "id": msg_id,
-                        "content": content,
-                        "is_self": bool(is_self),
-                        "timestamp": timestamp,
-                        "time": datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"),
-                        "message_type": msg_type or "text",
-                        "sender": sender or "",
-                        "attr": attr or ""
+                        "id": row["id"],
+                        "content": row["content"],
+                        "is_self": bool(row["is_self"]),
+                        "timestamp": row["timestamp"],
+                        "time": row["time"],
+                        "message_type": row["msg_type"] or "text",
+                        "sender": row["sender"] or "",
+                        "attr": row["attr"] or ""
                     }
 
                     # 只解析必要的额外数据
+                    extra_data = row["extra_data"]
                     if extra_data:
                         try:
                             extra = json.loads(extra_data)
@@ -1944,42 +2452,55 @@ class WxAutoBridge:
             logger.error(f"Failed to get messages from database: {e}")
             return []
 
-    def _get_messages_from_db_with_pagination(self, session_id: str, limit: int = 40, offset: int = 0) -> List[Dict[str, Any]]:
+    def _get_messages_from_db_with_pagination(self, session_id: str, limit: int = 40, offset: int = 0,
+                                              before_id: int = None) -> List[Dict[str, Any]]:
         """从数据库获取消息 - 带分页支持，获取最新的记录
 
         Args:
             session_id: 会话ID
             limit: 限制返回的消息数量
-            offset: 偏移量
+            offset: 偏移量（指定before_id时忽略）
+            before_id: 只返回id小于该值的消息（keyset分页，不需要扫描跳过的行）
         """
         try:
             current_wxid = self.get_current_wxid()
-            with sqlite3.connect(DB_PATH) as conn:
+            with self._get_db_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data
-                FROM messages
-                WHERE session_id = ? AND wxid = ?
-                ORDER BY id DESC
-                LIMIT ? OFFSET ?
-                ''', (session_id, current_wxid, limit, offset))
+                if before_id is not None:
+                    cursor.execute('''
+                    SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data,
+                           strftime('%Y-%m-%d %H:%M:%S', timestamp, 'unixepoch', 'localtime') AS time
+                    FROM messages
+                    WHERE session_id = ? AND wxid = ? AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                    ''', (session_id, current_wxid, before_id, limit))
+                else:
+                    cursor.execute('''
+                    SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data,
+                           strftime('%Y-%m-%d %H:%M:%S', timestamp, 'unixepoch', 'localtime') AS time
+                    FROM messages
+                    WHERE session_id = ? AND wxid = ?
+                    ORDER BY id DESC
+                    LIMIT ? OFFSET ?
+                    ''', (session_id, current_wxid, limit, offset))
                 rows = cursor.fetchall()
                 messages = []
 
                 for row in rows:
-                    msg_id, content, is_self, timestamp, msg_type, sender, attr, extra_data = row
                     message = {
-                        "id": msg_id,
-                        "content": content,
-                        "is_self": bool(is_self),
-                        "timestamp": timestamp,
-                        "time": datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"),
-                        "message_type": msg_type or "text",
-                        "sender": sender or "",
-                        "attr": attr or ""
+                        "id": row["id"],
+                        "content": row["content"],
+                        "is_self": bool(row["is_self"]),
+                        "timestamp": row["timestamp"],
+                        "time": row["time"],
+                        "message_type": row["msg_type"] or "text",
+                        "sender": row["sender"] or "",
+                        "attr": row["attr"] or ""
                     }
 
                     # 只解析必要的额外数据
+                    extra_data = row["extra_data"]
                     if extra_data:
                         try:
                             extra = json.loads(extra_data)
@@ -2004,7 +2525,7 @@ class WxAutoBridge:
         """获取指定会话的消息总数"""
         try:
             current_wxid = self.get_current_wxid()
-            with sqlite3.connect(DB_PATH) as conn:
+            with self._get_db_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                 SELECT COUNT(*) FROM messages
@@ -2100,7 +2621,7 @@ class WxAutoBridge:
                         "content": content,
                         "is_self": is_self,
                         "timestamp": timestamp,
-                        "time": datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"),
+                        "time": _format_timestamp(timestamp),
                         "message_type": message_type,
                         "sender": sender,
                         "attr": attr
@@ -2146,8 +2667,7 @@ class WxAutoBridge:
                 cursor = conn.cursor()
                 
                 # 检查表结构
-                cursor.execute("PRAGMA table_info(messages)")
-                columns = [column[1] for column in cursor.fetchall()]
+                columns = self._get_table_columns(cursor, "messages")
                 has_original_time = 'original_time' in columns
                 has_formatted_time = 'formatted_time' in columns
                 has_created_at = 'created_at' in columns
@@ -2196,8 +2716,7 @@ class WxAutoBridge:
                 logger.info(f"成功保存 {len(messages)} 条新消息到数据库")
 
         except Exception as e:
-            logger.error(f"Failed to save new messages to database: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Failed to save new messages to database: %s", e)
 
     def _wait_for_window_load(self, max_wait: int = 5) -> bool:
         """等待聊天窗口加载完成
@@ -2206,17 +2725,10 @@ class WxAutoBridge:
             max_wait: 最大等待时间（秒）
         """
         try:
-            for i in range(max_wait * 2):  # 每0.5秒检查一次
-                time.sleep(0.5)
-
-                # 尝试检查窗口是否已加载
-                # 这里可以添加更具体的窗口检查逻辑
-                if i >= 2:  # 至少等待1秒
-                    # 减少详细日志输出
-                    return True
-
-            logger.warning(f"聊天窗口加载超时 (等待 {max_wait} 秒)")
-            return True  # 即使超时也继续执行
+            # 目前没有可用的窗口就绪检查，固定等待约1秒（不超过max_wait）
+            # 这里可以添加更具体的窗口检查逻辑
+            time.sleep(min(1.0, max_wait))
+            return True
 
         except Exception as e:
             logger.error(f"等待窗口加载失败: {e}")
@@ -2227,14 +2739,16 @@ class WxAutoBridge:
         try:
             load_count = 0
             has_more_messages = True
+            # 首批间隔很短，随成功次数指数增长，最长1秒
+            delay = 0.1
 
             # 循环加载历史消息，直到没有更多消息或达到最大尝试次数
             while has_more_messages and load_count < max_attempts:
                 try:
                     # 减少详细日志输出
 
-                    if hasattr(self.wechat_client, 'LoadMoreMessage'):
-                        load_more_result = self.wechat_client.LoadMoreMessage()
+                    if self._load_more_message is not None:
+                        load_more_result = self._load_more_message()
                         logger.info(f"LoadMoreMessage第{load_count+1}次调用结果: {load_more_result}")
 
                         # 检查是否成功加载更多消息
@@ -2254,13 +2768,15 @@ class WxAutoBridge:
                             # 加载成功，但需要短暂延迟
                             logger.info(f"成功加载第{load_count+1}批历史消息")
                             load_count += 1
-                            time.sleep(1)  # 增加延迟，确保消息完全加载
+                            time.sleep(delay)  # 短暂延迟，确保消息完全加载
+                            delay = min(1.0, delay * 2)
                     else:
                         # 如果没有LoadMoreMessage方法，尝试按键方式
                         logger.info("使用按键方式加载更多消息")
                         if hasattr(self.wechat_client, 'SendKeys'):
                             self.wechat_client.SendKeys(keys='^{HOME}', wait_time=0.5)
-                            time.sleep(1)
+                            time.sleep(delay)
+                            delay = min(1.0, delay * 2)
                             load_count += 1
                         else:
                             logger.warning("无法加载更多消息，没有可用的方法")
@@ -2282,28 +2798,25 @@ class WxAutoBridge:
             # logger.info("开始获取消息，检查微信客户端状态...")
             # logger.info(f"微信客户端类型: {type(self.wechat_client)}")
 
-            # 检查微信客户端可用方法
-            if self.wechat_client:
-                available_methods = [method for method in dir(self.wechat_client) if not method.startswith('_')]
-
             # 使用wxautox获取消息
-            if hasattr(self.wechat_client, 'GetAllMessage'):
+            if self._get_all_message is not None:
                 # logger.info("✅ 找到GetAllMessage方法，开始调用...")
                 try:
-                    messages = self.wechat_client.GetAllMessage()
+                    messages = self._get_all_message()
                     # logger.info(f"GetAllMessage调用完成，返回类型: {type(messages)}")
 
                     if messages:
                         logger.info(f"✅ GetAllMessage返回 {len(messages)} 条消息")
                         # 打印第一条消息的详细信息用于调试
-                        if len(messages) > 0:
+                        if logger.isEnabledFor(logging.DEBUG):
                             first_msg = messages[0]
-                            logger.info(f"第一条消息类型: {type(first_msg)}")
-                            logger.info(f"第一条消息属性: {dir(first_msg)}")
-                            logger.info(f"第一条消息内容: content={getattr(first_msg, 'content', 'N/A')}")
-                            logger.info(f"第一条消息发送者: sender={getattr(first_msg, 'sender', 'N/A')}")
-                            logger.info(f"第一条消息属性: attr={getattr(first_msg, 'attr', 'N/A')}")
-                            logger.info(f"第一条消息哈希值: hash={getattr(first_msg, 'hash', 'N/A')}")
+                            logger.debug("第一条消息类型: %s", type(first_msg))
+                            if VERBOSE_DEBUG:
+                                logger.debug("第一条消息属性: %s", dir(first_msg))
+                            logger.debug("第一条消息内容: content=%s", getattr(first_msg, 'content', 'N/A'))
+                            logger.debug("第一条消息发送者: sender=%s", getattr(first_msg, 'sender', 'N/A'))
+                            logger.debug("第一条消息属性: attr=%s", getattr(first_msg, 'attr', 'N/A'))
+                            logger.debug("第一条消息哈希值: hash=%s", getattr(first_msg, 'hash', 'N/A'))
 
                         return messages
                     else:
@@ -2311,8 +2824,7 @@ class WxAutoBridge:
                         return []
 
                 except Exception as e:
-                    logger.error(f"❌ GetAllMessage调用异常: {e}")
-                    logger.error(traceback.format_exc())
+                    logger.exception("❌ GetAllMessage调用异常: %s", e)
                     return []
             else:
                 # 如果没有GetAllMessage方法，尝试其他方式
@@ -2330,179 +2842,131 @@ class WxAutoBridge:
                         return []
                 else:
                     logger.error("❌ 没有找到任何可用的消息获取方法")
-                    logger.error("可用方法列表:")
-                    for method in available_methods:
-                        logger.error(f"  - {method}")
+                    if self.wechat_client:
+                        logger.error("可用方法列表:")
+                        for method in dir(self.wechat_client):
+                            if not method.startswith('_'):
+                                logger.error(f"  - {method}")
 
                 return []
 
         except Exception as e:
-            logger.error(f"❌ _get_all_messages整体失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("❌ _get_all_messages整体失败: %s", e)
             return []
 
+    def _build_wxauto_message_row(self, msg: Any, i: int, session_id: str, current_wxid: str,
+                                  current_time: int, debug_enabled: bool) -> tuple:
+        """构建wxautox消息对象的数据库行"""
+        return self._build_parsed_message_row(_parse_object_message(msg, i, current_time),
+                                              session_id, current_wxid, debug_enabled)
+
+    def _build_dict_message_row(self, msg: Dict[str, Any], i: int, session_id: str, current_wxid: str,
+                                current_time: int, debug_enabled: bool) -> tuple:
+        """构建字典消息的数据库行"""
+        return self._build_parsed_message_row(_parse_dict_message(msg, current_time),
+                                              session_id, current_wxid, debug_enabled)
+
+    def _build_generic_message_row(self, msg: Any, i: int, session_id: str, current_wxid: str,
+                                   current_time: int, debug_enabled: bool) -> tuple:
+        """构建任意类型消息的数据库行（混合类型批次使用）"""
+        if hasattr(msg, '__dict__'):
+            parsed = _parse_object_message(msg, i, current_time)
+        elif isinstance(msg, dict):
+            parsed = _parse_dict_message(msg, current_time)
+        else:
+            parsed = _parse_text_message(msg if isinstance(msg, str) else str(msg), current_time)
+        return self._build_parsed_message_row(parsed, session_id, current_wxid, debug_enabled)
+
+    def _build_parsed_message_row(self, parsed: _ParsedMessage, session_id: str, current_wxid: str,
+                                  debug_enabled: bool) -> tuple:
+        """确定消息类型并构建数据库行，返回(_MessageRow, 用于构建返回结果的(content, is_self, timestamp, extra_data))"""
+        extra_data = parsed.extra_data
+        if parsed.sender == 'base' and parsed.attr == 'base' and parsed.msg_type == 'other':
+            # 这很可能是时间分隔符消息
+            message_type = 'time'
+            extra_data['message_type'] = 'time'
+        elif extra_data.get('message_type'):
+            message_type = extra_data['message_type']
+        else:
+            message_type = parsed.msg_type
+
+        if debug_enabled:
+            logger.debug("  保存消息: type='%s', content='%s...', sender='%s', attr='%s', hash='%s'",
+                         message_type, parsed.content[:30], parsed.sender, parsed.attr, parsed.hash)
+
+        row = _MessageRow(
+            session_id=session_id,
+            wxid=current_wxid,
+            content=parsed.content,
+            is_self=int(parsed.is_self),
+            timestamp=parsed.timestamp,
+            extra_data=_dump_extra_data(extra_data),
+            msg_type=message_type,
+            sender=parsed.sender,
+            attr=parsed.attr,
+            original_time=parsed.original_time,
+            formatted_time=parsed.formatted_time,
+            hash=parsed.hash
+        )
+        return row, (parsed.content, parsed.is_self, parsed.timestamp, extra_data)
+
     def _process_and_save_messages(self, messages: List[Any], session_id: str, contact_name: str) -> List[Dict[str, Any]]:
         """处理并保存消息到数据库"""
         try:
-            processed_messages = []
+            insert_rows = []  # 待写入数据库的行
+            out_rows = []  # (content, is_self, timestamp, extra_data)，写库后再构建返回结果
 
-            with sqlite3.connect(DB_PATH) as conn:
+            debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+            with self._get_db_connection() as conn:
                 cursor = conn.cursor()
 
                 # 先保存或更新会话信息
                 current_time = int(time.time())
                 current_wxid = self.get_current_wxid()
-                cursor.execute('''
-                INSERT OR REPLACE INTO sessions
-                (session_id, wxid, name, type, last_time, created_at, updated_at, chat_type)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (session_id, current_wxid, contact_name, 'private', current_time, current_time, current_time, 'friend'))
+                cursor.execute(SQL_UPSERT_SESSION,
+                               (session_id, current_wxid, contact_name, 'private', current_time, current_time, current_time, 'friend'))
+
+                # 同一批消息几乎总是同一种类型，这里只判断一次，选用专门的行构建函数
+                build_row = self._build_generic_message_row
+                if messages:
+                    first_type = type(messages[0])
+                    if all(type(m) is first_type for m in messages):
+                        if first_type is dict:
+                            build_row = self._build_dict_message_row
+                        elif hasattr(messages[0], '__dict__'):
+                            build_row = self._build_wxauto_message_row
 
                 for i, msg in enumerate(messages):
                     try:
-                        logger.info(f"处理第 {i+1}/{len(messages)} 条消息: {type(msg)}")
-
-                        # 解析消息内容 - 根据wxautox的消息对象结构
-                        content = ""
-                        is_self = False
-                        timestamp = current_time
-                        extra_data = {}
-                        sender = ''
-                        attr = ''
-                        original_time = ''
-                        formatted_time = ''
-                        msg_type_from_data = 'text'
-
-                        if hasattr(msg, '__dict__'):
-                            # wxautox消息对象
-                            content = getattr(msg, 'content', '')
-                            sender = getattr(msg, 'sender', '')
-                            attr = getattr(msg, 'attr', '')
-                            msg_type = getattr(msg, 'type', '')
-                            msg_time = getattr(msg, 'time', None)
-                            msg_hash = getattr(msg, 'hash', None)  # 获取消息hash值
-
-                            logger.info(f"  消息属性: content='{content[:30]}...', sender='{sender}', attr='{attr}', type='{msg_type}', hash='{msg_hash}'")
-
-                            # 判断是否为自己发送的消息
-                            is_self = (attr == 'self')
-
-                            # 处理时间 - 为每条消息生成唯一的时间戳
-                            if msg_time:
-                                try:
-                                    if isinstance(msg_time, str) and ":" in msg_time:
-                                        # 格式如 "14:30"
-                                        today = datetime.now().strftime("%Y-%m-%d")
-                                        time_str = f"{today} {msg_time}"
-                                        dt = datetime.strptime(time_str, "%Y-%m-%d %H:%M")
-                                        timestamp = int(dt.timestamp())
-                                    else:
-                                        timestamp = int(float(msg_time))
-                                except:
-                                    # 如果时间解析失败，使用当前时间加上消息索引来避免重复
-                                    timestamp = current_time + len(processed_messages)
-                            else:
-                                # 没有时间信息，使用当前时间加上消息索引来避免重复
-                                timestamp = current_time + len(processed_messages)
-
-                            # 保存额外数据 - 只保存必要信息
-                            extra_data = {
-                                'message_type': 'time' if (sender == 'base' and attr == 'base') else 'text'
-                            }
-
-                            # 设置其他字段
-                            original_time = str(msg_time) if msg_time else ''
-                            formatted_time = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
-                            msg_type_from_data = msg_type
-
-                        elif isinstance(msg, dict):
-                            content = msg.get('content', str(msg))
-                            is_self = msg.get('is_self', False)
-                            timestamp = msg.get('timestamp', current_time)
-
-                            # 提取wxautox消息的所有属性
-                            sender = msg.get('sender', '')
-                            attr = msg.get('attr', '')
-                            original_time = msg.get('original_time', '')
-                            formatted_time = msg.get('time', '')
-                            msg_type_from_data = msg.get('msg_type', 'text')
-
-                            # 保留其他属性到extra_data
-                            extra_data = {k: v for k, v in msg.items() if k not in [
-                                'content', 'is_self', 'timestamp', 'sender', 'attr', 'original_time', 'time', 'msg_type'
-                            ]}
-                        elif isinstance(msg, str):
-                            content = msg
-                            sender = ''
-                            attr = ''
-                            original_time = ''
-                            formatted_time = ''
-                            msg_type_from_data = 'text'
-                            extra_data = {}
-                        else:
-                            content = str(msg)
-                            sender = ''
-                            attr = ''
-                            original_time = ''
-                            formatted_time = ''
-                            msg_type_from_data = 'text'
-                            extra_data = {}
-
-                        # 根据数据确定消息类型
-                        message_type = 'text'  # 默认为普通文本消息
-
-                        # 检查是否为时间消息 - 根据sender和attr判断
-                        if sender == 'base' and attr == 'base' and msg_type_from_data == 'other':
-                            # 这很可能是时间分隔符消息
-                            message_type = 'time'
-                            extra_data['message_type'] = 'time'
-                        elif extra_data.get('message_type'):
-                            message_type = extra_data['message_type']
-                        elif msg_type_from_data == 'system':
-                            message_type = 'system'
-                        else:
-                            message_type = msg_type_from_data
-
-                        # 直接保存所有消息，不进行去重
-                        logger.info(f"  保存消息: type='{message_type}', content='{content[:30]}...', sender='{sender}', attr='{attr}'")
-
-                        # 保存到数据库
-                        cursor.execute('''
-                        INSERT INTO messages (session_id, wxid, content, is_self, timestamp, extra_data, msg_type, sender, attr, original_time, formatted_time, hash)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            session_id,
-                            current_wxid,
-                            content,
-                            int(is_self),
-                            timestamp,
-                            json.dumps(extra_data) if extra_data else None,
-                            message_type,
-                            sender,
-                            attr,
-                            original_time,
-                            formatted_time,
-                            msg_hash if 'msg_hash' in locals() else None
-                        ))
+                        if debug_enabled:
+                            logger.debug("处理第 %d/%d 条消息: %s", i + 1, len(messages), type(msg))
 
-                        # 添加到处理后的消息列表
-                        processed_message = {
-                            "content": content,
-                            "is_self": is_self,
-                            "timestamp": timestamp,
-                            "time": datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
-                        }
-                        processed_message.update(extra_data)
-                        processed_messages.append(processed_message)
+                        row, out_row = build_row(msg, i, session_id, current_wxid, current_time, debug_enabled)
+                        insert_rows.append(row)
+                        out_rows.append(out_row)
 
                     except Exception as e:
                         logger.error(f"Failed to process message: {e}")
                         continue
 
-                conn.commit()
-                logger.info(f"成功保存 {len(processed_messages)} 条消息到数据库")
+                # 一次性批量写入
+                cursor.executemany(SQL_INSERT_MESSAGE, insert_rows)
 
-            return processed_messages
+                conn.commit()
+                logger.info(f"成功保存 {len(insert_rows)} 条消息到数据库")
+
+            # 写库完成后统一构建返回结果
+            return [
+                {
+                    "content": content,
+                    "is_self": is_self,
+                    "timestamp": timestamp,
+                    "time": _format_timestamp(timestamp),
+                    **extra_data
+                }
+                for content, is_self, timestamp, extra_data in out_rows
+            ]
 
         except Exception as e:
             logger.error(f"Failed to process and save messages: {e}")
@@ -2514,27 +2978,29 @@ class WxAutoBridge:
             return {"success": False, "message": "WeChat not connected"}
 
         try:
-            session_id = f"private_self_{contact_name}"
+            session_id = _private_session_id(contact_name)
 
             # 从数据库获取更多消息
-            with sqlite3.connect(DB_PATH) as conn:
+            with self._get_db_connection() as conn:
                 cursor = conn.cursor()
 
                 current_wxid = self.get_current_wxid()
                 if before_timestamp:
                     cursor.execute('''
-                    SELECT content, is_self, timestamp, extra_data, msg_type, sender, attr
+                    SELECT content, is_self, timestamp, extra_data, msg_type, sender, attr,
+                           strftime('%Y-%m-%d %H:%M:%S', timestamp, 'unixepoch', 'localtime') AS time
                     FROM messages
                     WHERE session_id = ? AND wxid = ? AND timestamp < ?
-                    ORDER BY timestamp DESC
+                    ORDER BY timestamp DESC, id DESC
                     LIMIT ?
                     ''', (session_id, current_wxid, before_timestamp, limit))
                 else:
                     cursor.execute('''
-                    SELECT content, is_self, timestamp, extra_data, msg_type, sender, attr
+                    SELECT content, is_self, timestamp, extra_data, msg_type, sender, attr,
+                           strftime('%Y-%m-%d %H:%M:%S', timestamp, 'unixepoch', 'localtime') AS time
                     FROM messages
                     WHERE session_id = ? AND wxid = ?
-                    ORDER BY timestamp DESC
+                    ORDER BY timestamp DESC, id DESC
                     LIMIT ?
                     ''', (session_id, current_wxid, limit))
 
@@ -2542,18 +3008,18 @@ class WxAutoBridge:
                 messages = []
 
                 for row in rows:
-                    content, is_self, timestamp, extra_data, msg_type, sender, attr = row
                     message = {
-                        "content": content,
-                        "is_self": bool(is_self),
-                        "timestamp": timestamp,
-                        "time": datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"),
-                        "message_type": msg_type or "text",
-                        "sender": sender or "",
-                        "attr": attr or ""
+                        "content": row["content"],
+                        "is_self": bool(row["is_self"]),
+                        "timestamp": row["timestamp"],
+                        "time": row["time"],
+                        "message_type": row["msg_type"] or "text",
+                        "sender": row["sender"] or "",
+                        "attr": row["attr"] or ""
                     }
 
                     # 只解析必要的额外数据
+                    extra_data = row["extra_data"]
                     if extra_data:
                         try:
                             extra = json.loads(extra_data)
@@ -2580,59 +3046,112 @@ class WxAutoBridge:
             logger.error(f"Failed to load more message history: {e}")
             return {"success": False, "message": str(e)}
 
+    def _query_page_suggestions(self, cursor, session_id: str, wxid: str, message_ids: List[int]) -> List[Dict[str, Any]]:
+        """获取当前页消息对应的回复建议
+
+        只按本页消息ID查询，查询量与页大小相关，而不是会话内的全部建议。
+        本页没有消息时直接返回空列表。
+        """
+        if not message_ids:
+            return []
+
+        placeholders = ','.join('?' * len(message_ids))
+        cursor.execute(f'''
+            SELECT rs.id, rs.content, rs.message_id, rs.timestamp, rs.created_at, rs.used
+            FROM reply_suggestions rs
+            WHERE rs.session_id = ? AND rs.wxid = ? AND rs.message_id IN ({placeholders})
+            ORDER BY rs.timestamp DESC
+        ''', (session_id, wxid, *message_ids))
+
+        return [
+            {
+                "id": row[0],
+                "content": row[1],
+                "message_id": row[2],
+                "timestamp": row[3],
+                "created_at": row[4],
+                "used": bool(row[5]),
+                "formatted_time": _format_timestamp(row[3])
+            }
+            for row in cursor.fetchall()
+        ]
+
     def get_session_messages(self, session_id: str, page: int = 1, limit: int = 40) -> Dict[str, Any]:
         """获取指定会话的消息列表（与前端API一致）"""
         try:
             # 解析session_id获取联系人名称
             contact_name = None
-            if session_id.startswith('private_self_'):
-                contact_name = session_id[13:]  # 移除 'private_self_' 前缀
-            elif session_id.startswith('group_'):
-                contact_name = session_id[6:]   # 移除 'group_' 前缀
+            for prefix in _SESSION_PREFIXES:
+                if session_id.startswith(prefix):
+                    contact_name = session_id.removeprefix(prefix)
+                    break
 
             if not contact_name:
                 return {"success": False, "message": "无效的会话ID"}
 
+            # 刷新后的消息可能仍在后台保存，先等待写入完成
+            self._wait_pending_save(contact_name)
+
             # 计算偏移量
             offset = (page - 1) * limit
 
             # 从数据库获取消息
-            with sqlite3.connect(DB_PATH) as conn:
+            with self._get_db_connection() as conn:
                 cursor = conn.cursor()
 
                 current_wxid = self.get_current_wxid()
-                # 获取总数
-                cursor.execute('''
-                SELECT COUNT(*) FROM messages WHERE session_id = ? AND wxid = ?
-                ''', (session_id, current_wxid))
-                total = cursor.fetchone()[0]
+                total = None
+                if SQLITE_HAS_WINDOW_FUNCTIONS:
+                    # 获取分页消息，总数通过窗口函数随同一次查询返回
+                    cursor.execute('''
+                    SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data,
+                           strftime('%Y-%m-%d %H:%M:%S', timestamp, 'unixepoch', 'localtime') AS time,
+                           COUNT(*) OVER () AS total
+                    FROM messages
+                    WHERE session_id = ? AND wxid = ?
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ? OFFSET ?
+                    ''', (session_id, current_wxid, limit, offset))
+                    rows = cursor.fetchall()
+                    if rows:
+                        total = rows[0]["total"]
+                    elif offset == 0:
+                        total = 0
+                else:
+                    # 获取分页消息，只查询必要字段
+                    cursor.execute('''
+                    SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data,
+                           strftime('%Y-%m-%d %H:%M:%S', timestamp, 'unixepoch', 'localtime') AS time
+                    FROM messages
+                    WHERE session_id = ? AND wxid = ?
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ? OFFSET ?
+                    ''', (session_id, current_wxid, limit, offset))
+                    rows = cursor.fetchall()
 
-                # 获取分页消息，只查询必要字段
-                cursor.execute('''
-                SELECT id, content, is_self, timestamp, msg_type, sender, attr, extra_data
-                FROM messages
-                WHERE session_id = ? AND wxid = ?
-                ORDER BY timestamp DESC
-                LIMIT ? OFFSET ?
-                ''', (session_id, current_wxid, limit, offset))
+                if total is None:
+                    # 旧版SQLite或页码越界时单独获取总数
+                    cursor.execute('''
+                    SELECT COUNT(*) FROM messages WHERE session_id = ? AND wxid = ?
+                    ''', (session_id, current_wxid))
+                    total = cursor.fetchone()[0]
 
-                rows = cursor.fetchall()
                 messages = []
 
                 for row in rows:
-                    msg_id, content, is_self, timestamp, msg_type, sender, attr, extra_data = row
                     message = {
-                        "id": msg_id,
-                        "content": content,
-                        "is_self": bool(is_self),
-                        "time": datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"),
-                        "timestamp": timestamp,
-                        "message_type": msg_type or "text",
-                        "sender": sender or "",
-                        "attr": attr or ""
+                        "id": row["id"],
+                        "content": row["content"],
+                        "is_self": bool(row["is_self"]),
+                        "time": row["time"],
+                        "timestamp": row["timestamp"],
+                        "message_type": row["msg_type"] or "text",
+                        "sender": row["sender"] or "",
+                        "attr": row["attr"] or ""
                     }
 
                     # 只解析必要的额外数据
+                    extra_data = row["extra_data"]
                     if extra_data:
                         try:
                             extra = json.loads(extra_data)
@@ -2652,36 +3171,16 @@ class WxAutoBridge:
                 suggestions = []
                 
                 # 检查表是否存在
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='reply_suggestions'")
-                if not cursor.fetchone():
+                if not self._table_exists(cursor, "reply_suggestions"):
                     logger.warning("reply_suggestions表不存在，无法获取回复建议")
                 else:
                     try:
-                        cursor.execute('''
-                            SELECT rs.id, rs.content, rs.message_id, rs.timestamp, rs.created_at, rs.used
-                            FROM reply_suggestions rs
-                            JOIN messages m ON rs.message_id = m.id
-                            WHERE rs.session_id = ? AND rs.wxid = ?
-                            ORDER BY rs.timestamp DESC
-                        ''', (session_id, current_wxid))
-                        
-                        rows = cursor.fetchall()
-                        logger.info(f"查询到 {len(rows)} 条回复建议")
-                        
-                        for row in rows:
-                            suggestion = {
-                                "id": row[0],
-                                "content": row[1],
-                                "message_id": row[2],
-                                "timestamp": row[3],
-                                "created_at": row[4],
-                                "used": bool(row[5]),
-                                "formatted_time": datetime.fromtimestamp(row[3]).strftime("%Y-%m-%d %H:%M:%S")
-                            }
-                            suggestions.append(suggestion)
+                        # 只查询本页消息对应的建议
+                        suggestions = self._query_page_suggestions(
+                            cursor, session_id, current_wxid, [m["id"] for m in messages])
+                        logger.info(f"查询到 {len(suggestions)} 条回复建议")
                     except Exception as e:
-                        logger.error(f"查询回复建议失败: {e}")
-                        logger.error(traceback.format_exc())
+                        logger.exception("查询回复建议失败: %s", e)
 
                 return {
                     "success": True,
@@ -2697,17 +3196,25 @@ class WxAutoBridge:
             logger.error(f"Failed to get session messages: {e}")
             return {"success": False, "message": str(e)}
 
-    def get_messages_from_db(self, contact_name: str, page: int = 1, per_page: int = 40) -> Dict[str, Any]:
-        """专门用于刷新消息的方法 - 仅从数据库获取数据，绝不调用wxautox"""
+    def get_messages_from_db(self, contact_name: str, page: int = 1, per_page: int = 40,
+                             before_id: int = None) -> Dict[str, Any]:
+        """专门用于刷新消息的方法 - 仅从数据库获取数据，绝不调用wxautox
+
+        指定before_id时按id游标分页（返回该id之前的per_page条），忽略page；
+        返回数据中的before_id可直接用于请求下一页更早的消息。
+        """
         try:
             logger.info(f"🔄 [刷新消息] 开始执行：{contact_name}")
             logger.info(f"🔄 [刷新消息] 此方法专门用于刷新消息，只从数据库获取数据")
             logger.info(f"🔄 [刷新消息] 绝对不会调用任何wxautox相关方法")
-            logger.info(f"📊 分页参数：page={page}, per_page={per_page}")
+            logger.info(f"📊 分页参数：page={page}, per_page={per_page}, before_id={before_id}")
 
-            session_id = f"private_self_{contact_name}"
+            session_id = _private_session_id(contact_name)
             current_wxid = self.get_current_wxid()
 
+            # 刷新后的消息可能仍在后台保存，先等待写入完成
+            self._wait_pending_save(contact_name)
+
             if not current_wxid:
                 logger.warning("⚠️ 未获取到当前用户wxid")
                 return {
@@ -2718,15 +3225,27 @@ class WxAutoBridge:
 
             # 直接从数据库获取消息，绝不调用wxautox，限制数量防止数据过大
             logger.info(f"📊 从数据库查询消息：session_id={session_id}, wxid={current_wxid}")
-            # 计算分页偏移量，获取最新的记录
-            offset = (page - 1) * per_page
-            logger.info(f"🔧 准备调用 _get_messages_from_db_with_pagination，参数：session_id={session_id}, limit={per_page}, offset={offset}")
-            existing_messages = self._get_messages_from_db_with_pagination(session_id, limit=per_page, offset=offset)
+            has_more = None
+            if before_id is not None:
+                # 游标分页：多取一条用于判断是否还有更早的消息
+                logger.info(f"🔧 准备调用 _get_messages_from_db_with_pagination，参数：session_id={session_id}, limit={per_page}, before_id={before_id}")
+                existing_messages = self._get_messages_from_db_with_pagination(session_id, limit=per_page + 1, before_id=before_id)
+                has_more = len(existing_messages) > per_page
+                if has_more:
+                    # 结果按id升序，多取的那条是最早的一条
+                    existing_messages = existing_messages[1:]
+            else:
+                # 计算分页偏移量，获取最新的记录
+                offset = (page - 1) * per_page
+                logger.info(f"🔧 准备调用 _get_messages_from_db_with_pagination，参数：session_id={session_id}, limit={per_page}, offset={offset}")
+                existing_messages = self._get_messages_from_db_with_pagination(session_id, limit=per_page, offset=offset)
             logger.info(f"📊 数据库查询结果：{len(existing_messages)} 条消息（已按正确顺序排列）")
             logger.info(f"🔍 返回的消息ID范围：{existing_messages[0]['id'] if existing_messages else 'N/A'} - {existing_messages[-1]['id'] if existing_messages else 'N/A'}")
 
             # 获取总数用于分页信息
             total = self._get_messages_count(session_id)
+            if has_more is None:
+                has_more = total > page * per_page
             paginated_messages = existing_messages
 
             logger.info(f"📄 分页处理完成：第{page}页，每页{per_page}条，返回{len(paginated_messages)}条")
@@ -2742,47 +3261,27 @@ class WxAutoBridge:
                     cursor = conn.cursor()
                     
                     # 检查表是否存在
-                    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='reply_suggestions'")
-                    if not cursor.fetchone():
+                    if not self._table_exists(cursor, "reply_suggestions"):
                         logger.warning("reply_suggestions表不存在，无法获取回复建议")
                     else:
                         # 查询回复建议
                         try:
-                            cursor.execute('''
-                                SELECT rs.id, rs.content, rs.message_id, rs.timestamp, rs.created_at, rs.used
-                                FROM reply_suggestions rs
-                                JOIN messages m ON rs.message_id = m.id
-                                WHERE rs.session_id = ? AND rs.wxid = ?
-                                ORDER BY rs.timestamp DESC
-                            ''', (session_id, current_wxid))
-                            
-                            rows = cursor.fetchall()
-                            logger.info(f"查询到 {len(rows)} 条回复建议")
-                            
-                            for row in rows:
-                                suggestion = {
-                                    "id": row[0],
-                                    "content": row[1],
-                                    "message_id": row[2],
-                                    "timestamp": row[3],
-                                    "created_at": row[4],
-                                    "used": bool(row[5]),
-                                    "formatted_time": datetime.fromtimestamp(row[3]).strftime("%Y-%m-%d %H:%M:%S")
-                                }
-                                suggestions.append(suggestion)
+                            # 只查询本页消息对应的建议
+                            suggestions = self._query_page_suggestions(
+                                cursor, session_id, current_wxid, [m["id"] for m in paginated_messages])
+                            logger.info(f"查询到 {len(suggestions)} 条回复建议")
                         except Exception as e:
-                            logger.error(f"查询回复建议失败: {e}")
-                            logger.error(traceback.format_exc())
+                            logger.exception("查询回复建议失败: %s", e)
             except Exception as e:
-                logger.error(f"获取回复建议时出错: {e}")
-                logger.error(traceback.format_exc())
+                logger.exception("获取回复建议时出错: %s", e)
 
             return {
                 "success": True,
                 "data": {
                     "messages": paginated_messages,
                     "total": total,
-                    "has_more": total > page * per_page,
+                    "has_more": has_more,
+                    "before_id": paginated_messages[0]["id"] if paginated_messages else None,
                     "source": "database_only",
                     "new_count": 0,
                     "suggestions": suggestions
@@ -2793,15 +3292,22 @@ class WxAutoBridge:
             logger.error(f"Failed to get messages from database: {e}")
             return {"success": False, "message": str(e)}
 
-    def clear_chat_messages(self, contact_name: str) -> Dict[str, Any]:
-        """清空指定联系人的聊天记录（参考index.html的clearChat逻辑）"""
+    def get_more_messages_from_db(self, contact_name: str, before_id: int = None, limit: int = 20) -> Dict[str, Any]:
+        """按id游标加载更早的消息，before_id为空时返回最新一页"""
+        return self.get_messages_from_db(contact_name, per_page=limit, before_id=before_id)
+
+    def clear_chat_messages(self, contact_name: str, current_wxid: str = None) -> Dict[str, Any]:
+        """清空指定联系人的聊天记录（参考index.html的clearChat逻辑），current_wxid为空时自动获取"""
         try:
             # 创建会话ID
-            session_id = f"private_self_{contact_name}"
-            current_wxid = self.get_current_wxid()
+            # 等待该联系人的后台保存完成，避免清空后又被写入
+            self._wait_pending_save(contact_name)
+
+            session_id = _private_session_id(contact_name)
+            current_wxid = current_wxid or self.get_current_wxid()
             logger.info(f"开始清空会话 {session_id} (wxid: {current_wxid}) 的聊天记录")
 
-            with sqlite3.connect(DB_PATH) as conn:
+            with self._get_db_connection() as conn:
                 cursor = conn.cursor()
 
                 # 查询该会话有多少条消息
@@ -2835,7 +3341,7 @@ class WxAutoBridge:
             return {"success": False, "message": error_msg}
 
     def refresh_chat_messages(self, contact_name: str) -> Dict[str, Any]:
-        """重新获取聊天记录（简化逻辑：清空数据库 -> 获取新数据 -> 保存到数据库 -> 调用刷新方法）"""
+        """重新获取聊天记录（获取新数据 -> 与数据库比对，有变化时清空并保存 -> 返回第一页）"""
         try:
             logger.info(f"🔄 [重新获取聊天记录] 开始执行：{contact_name}")
 
@@ -2846,15 +3352,12 @@ class WxAutoBridge:
             if not self.wechat_client:
                 return {"success": False, "message": "微信客户端未连接，请先初始化微信"}
 
-            # 步骤1: 清空数据库中该联系人的聊天记录
-            logger.info("🗑️ 步骤1: 清空数据库中的旧聊天记录...")
-            clear_result = self.clear_chat_messages(contact_name)
-            if not clear_result.get("success"):
-                logger.error(f"❌ 清空聊天记录失败: {clear_result.get('message')}")
-                return clear_result
+            # 整个刷新过程使用同一个wxid，避免中途切换账号导致清空和写入的不是同一份数据
+            session_id = _private_session_id(contact_name)
+            current_wxid = self.get_current_wxid()
 
-            # 步骤2: 调用wxautox方法获取新的聊天记录
-            logger.info("📱 步骤2: 从微信获取新的聊天记录...")
+            # 步骤1: 调用wxautox方法获取新的聊天记录
+            logger.info("📱 步骤1: 从微信获取新的聊天记录...")
             real_messages_result = self._get_real_chat_messages(contact_name)
 
             if not real_messages_result.get("success"):
@@ -2867,41 +3370,85 @@ class WxAutoBridge:
             messages = real_messages_result.get("messages", [])
             logger.info(f"✅ 从微信获取到 {len(messages)} 条消息")
 
-            # 步骤3: 保存新消息到数据库
-            logger.info("💾 步骤3: 保存新消息到数据库...")
-            save_result = self._save_real_messages_to_db(messages, contact_name)
-            if not save_result.get("success"):
-                logger.error(f"❌ 保存消息到数据库失败: {save_result.get('message')}")
-                return {
-                    "success": False,
-                    "message": f"保存消息到数据库失败: {save_result.get('message', '未知错误')}"
-                }
-
-            logger.info(f"✅ 成功保存 {save_result.get('saved_count', 0)} 条消息到数据库")
-
-            # 步骤4: 调用刷新消息方法从数据库加载第一页数据（支持分页）
-            logger.info("📄 步骤4: 从数据库加载第一页消息（支持分页）...")
-            refresh_result = self.get_messages_from_db(contact_name, page=1, per_page=20)
+            rows = self._build_real_message_rows(messages, session_id, current_wxid)
+            if not rows:
+                return {"success": False, "message": "保存消息到数据库失败: 没有消息需要保存"}
+
+            # 步骤2: 与数据库中的消息比对，完全一致时不必重写
+            if self._session_hashes_unchanged(contact_name, session_id, current_wxid, rows):
+                logger.info("✅ 步骤2: 聊天记录没有变化，跳过重写，直接返回数据库中的第一页")
+                result = self.get_messages_from_db(contact_name, per_page=20)
+                if result.get("success"):
+                    result["message"] = f"重新获取成功，获得 {len(messages)} 条消息，聊天记录没有变化"
+                    result["data"]["source"] = "wxautox"
+                return result
 
-            if refresh_result.get("success"):
-                logger.info(f"✅ 重新获取聊天记录完成，返回第一页 {len(refresh_result.get('data', {}).get('messages', []))} 条消息")
-                return {
-                    "success": True,
-                    "message": f"重新获取成功，获得 {len(messages)} 条消息，返回第一页数据",
-                    "data": refresh_result.get("data", {})
+            # 步骤3: 有变化时在保存线程中清空旧记录并整体重写（同一个事务，失败时回滚，原有聊天记录保持不变）
+            logger.info("💾 步骤3: 后台清空旧聊天记录并保存新消息...")
+            self._submit_message_save(contact_name, rows, current_wxid, replace=True)
+
+            # 步骤4: 直接用内存中的数据构建第一页。此时消息还没有写入、没有id，
+            # 通过pending_save告知前端稍后重新读取数据库（读取会等待保存完成）
+            logger.info("📄 步骤4: 构建第一页消息...")
+            page_messages = [
+                {
+                    "content": row.content,
+                    "is_self": bool(row.is_self),
+                    "timestamp": row.timestamp,
+                    "time": row.formatted_time,
+                    "message_type": "time" if row.extra_data == EXTRA_TIME else "text",
+                    "sender": row.sender or "",
+                    "attr": row.attr or ""
                 }
-            else:
-                logger.error(f"❌ 从数据库加载消息失败: {refresh_result.get('message')}")
-                return {
-                    "success": False,
-                    "message": f"从数据库加载消息失败: {refresh_result.get('message', '未知错误')}"
+                for row in rows[-20:]
+            ]
+
+            logger.info(f"✅ 重新获取聊天记录完成，返回第一页 {len(page_messages)} 条消息")
+            return {
+                "success": True,
+                "message": f"重新获取成功，获得 {len(messages)} 条消息，返回第一页数据",
+                "data": {
+                    "messages": page_messages,
+                    "total": len(rows),
+                    "has_more": len(rows) > 20,
+                    "before_id": None,
+                    "pending_save": True,
+                    "source": "wxautox",
+                    "new_count": 0,
+                    "suggestions": []
                 }
+            }
 
         except Exception as e:
             error_msg = f"重新获取聊天记录失败: {str(e)}"
             logger.error(error_msg)
             return {"success": False, "message": error_msg}
 
+    def _session_hashes_unchanged(self, contact_name: str, session_id: str, current_wxid: str,
+                                  rows: List[tuple]) -> bool:
+        """数据库中该会话的消息hash序列与rows完全一致时返回True（先等待该联系人尚未完成的后台保存）"""
+        self._wait_pending_save(contact_name)
+        new_hashes = [row.hash for row in rows]
+        if None in new_hashes:
+            return False
+
+        cursor = self._get_db_connection().execute(
+            "SELECT hash FROM messages WHERE session_id = ? AND wxid = ? ORDER BY id",
+            (session_id, current_wxid))
+        return [row[0] for row in cursor] == new_hashes
+
+    def _wait_for_message_count(self, min_count: int, timeout: float) -> int:
+        """每0.1秒轮询一次GetAllMessage，直到消息数超过min_count或超时，返回最后一次的消息数"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                count = len(self._get_all_message() or [])
+            except Exception:
+                count = 0
+            if count > min_count or time.monotonic() >= deadline:
+                return count
+            time.sleep(0.1)
+
     def _get_real_chat_messages(self, contact_name: str) -> Dict[str, Any]:
         """获取真实的聊天消息（基于测试成功的逻辑）"""
         try:
@@ -2924,37 +3471,44 @@ class WxAutoBridge:
             except Exception as e:
                 return {"success": False, "message": f"打开聊天窗口失败: {str(e)}"}
 
-            # 2. 等待窗口加载
+            # 2. 等待窗口加载（出现消息即可，最多3秒）
             logger.info("2️⃣ 等待聊天窗口加载...")
-            time.sleep(3)
+            can_poll = self._get_all_message is not None
+            message_count = 0
+            if can_poll:
+                message_count = self._wait_for_message_count(0, 3.0)
+            else:
+                time.sleep(3)
 
             # 3. 尝试加载更多历史消息
             logger.info("3️⃣ 尝试加载历史消息...")
-            if hasattr(self.wechat_client, 'LoadMoreMessage'):
+            if self._load_more_message is not None:
                 for i in range(2):  # 加载2次
                     try:
-                        load_result = self.wechat_client.LoadMoreMessage()
+                        load_result = self._load_more_message()
                         logger.info(f"   第{i+1}次加载: {load_result}")
-                        time.sleep(1)
+                        # 等待消息数增加，最多1秒；加载失败（没有更多消息）时不必等待
+                        if not can_poll:
+                            time.sleep(1)
+                        elif load_result:
+                            message_count = self._wait_for_message_count(message_count, 1.0)
                     except Exception as e:
                         logger.warning(f"   第{i+1}次加载失败: {e}")
 
             # 4. 获取所有消息
             logger.info("4️⃣ 获取所有消息...")
-            if hasattr(self.wechat_client, 'GetAllMessage'):
+            if self._get_all_message is not None:
                 try:
-                    messages = self.wechat_client.GetAllMessage()
+                    messages = self._get_all_message()
                     if messages:
                         logger.info(f"✅ 获取到 {len(messages)} 条真实消息")
 
                         # 记录获取到的消息详情用于调试
-                        logger.info(f"📊 GetAllMessage返回的消息样本（前3条）:")
+                        logger.info("📊 GetAllMessage返回的消息样本（前3条）:")
                         for i, msg in enumerate(messages[:3]):
-                            content = getattr(msg, 'content', '')
-                            sender = getattr(msg, 'sender', '')
-                            attr = getattr(msg, 'attr', '')
-                            msg_time = getattr(msg, 'time', '')
-                            logger.info(f"  [{i+1}] content='{content[:40]}...', sender='{sender}', attr='{attr}', time='{msg_time}'")
+                            logger.info("  [%d] content='%s...', sender='%s', attr='%s', time='%s'",
+                                        i + 1, getattr(msg, 'content', '')[:40], getattr(msg, 'sender', ''),
+                                        getattr(msg, 'attr', ''), getattr(msg, 'time', ''))
 
                         return {"success": True, "messages": messages}
                     else:
@@ -2972,96 +3526,178 @@ class WxAutoBridge:
         """将真实消息保存到数据库"""
         try:
             logger.info(f"💾 保存真实消息到数据库...")
-            logger.info(f"📊 准备保存 {len(messages)} 条消息，不进行去重")
+            logger.info(f"📊 准备保存 {len(messages)} 条消息，按hash去重")
 
             if not messages:
                 return {"success": False, "message": "没有消息需要保存"}
 
-            session_id = f"private_self_{contact_name}"
-            current_time = int(time.time())
+            session_id = _private_session_id(contact_name)
             current_wxid = self.get_current_wxid()
+            rows = self._build_real_message_rows(messages, session_id, current_wxid)
+            return self._write_real_message_rows(rows, contact_name, current_wxid)
 
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
+        except Exception as e:
+            logger.error(f"保存真实消息失败: {e}")
+            return {"success": False, "message": f"保存失败: {str(e)}"}
 
-                # 创建会话记录（如果不存在）
-                cursor.execute('''
-                INSERT OR REPLACE INTO sessions (session_id, wxid, name, type, last_time, created_at, updated_at, chat_type)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (session_id, current_wxid, contact_name, 'private', current_time, current_time, current_time, 'friend'))
+    def _build_real_message_rows(self, messages, session_id: str, current_wxid: str) -> List[_MessageRow]:
+        """将wxautox消息转换为messages表的行"""
+        current_time = int(time.time())
 
-                # 保存消息
-                saved_count = 0
-                for i, msg in enumerate(messages):
+        # 先构建全部行，再一次性批量写入
+        rows = []
+        today_prefix = datetime.now().strftime("%Y-%m-%d ")  # 循环内不变，只取一次当前日期
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        seen_hashes = set()
+        for i, msg in enumerate(messages):
+            try:
+                try:
+                    content, sender, attr, msg_type, msg_time, msg_hash = _get_message_fields(msg)
+                except AttributeError:
+                    # 缺少部分属性的消息对象，逐个读取并使用默认值
+                    content = getattr(msg, 'content', '')
+                    sender = getattr(msg, 'sender', '')
+                    attr = getattr(msg, 'attr', '')
+                    msg_type = getattr(msg, 'type', 'text')
+                    msg_time = getattr(msg, 'time', None)
+                    msg_hash = getattr(msg, 'hash', None)  # 获取消息hash值
+
+                # 详细日志记录每条消息的保存过程（仅DEBUG级别）
+                if debug_enabled:
+                    logger.debug("  保存第%d条消息: content='%s...', sender='%s', attr='%s', type='%s', time='%s', hash='%s'",
+                                 i + 1, content[:30], sender, attr, msg_type, msg_time, msg_hash)
+
+                # 判断是否为自己发送的消息
+                is_self = (attr == 'self')
+
+                # 处理时间戳 - 使用真实时间，不再逐条递增；时间相同的消息按id（写入顺序）排序
+                timestamp = current_time
+                if msg_time and isinstance(msg_time, str) and ":" in msg_time:
                     try:
-                        content = getattr(msg, 'content', '')
-                        sender = getattr(msg, 'sender', '')
-                        attr = getattr(msg, 'attr', '')
-                        msg_type = getattr(msg, 'type', 'text')
-                        msg_time = getattr(msg, 'time', None)
-                        msg_hash = getattr(msg, 'hash', None)  # 获取消息hash值
-
-                        # 详细日志记录每条消息的保存过程
-                        logger.info(f"  保存第{i+1}条消息: content='{content[:30]}...', sender='{sender}', attr='{attr}', type='{msg_type}', time='{msg_time}', hash='{msg_hash}'")
-
-                        # 判断是否为自己发送的消息
-                        is_self = (attr == 'self')
+                        dt = datetime.strptime(today_prefix + msg_time, "%Y-%m-%d %H:%M")
+                        timestamp = int(dt.timestamp())
+                    except:
+                        timestamp = current_time  # 解析失败时使用当前时间
+
+                # 确定消息类型和额外数据（直接使用预先序列化的字符串）
+                type_info = _MESSAGE_TYPE_MAP.get((sender, attr, msg_type))
+                if type_info:
+                    message_type, extra_data = type_info
+                else:
+                    message_type = msg_type
+                    extra_data = EXTRA_TIME if (sender == 'base' and attr == 'base') else EXTRA_TEXT
 
-                        # 处理时间戳 - 确保每条消息都有唯一的时间戳
-                        timestamp = current_time + i  # 使用递增时间戳确保唯一性
-                        if msg_time and isinstance(msg_time, str) and ":" in msg_time:
-                            try:
-                                today = datetime.now().strftime("%Y-%m-%d")
-                                time_str = f"{today} {msg_time}"
-                                dt = datetime.strptime(time_str, "%Y-%m-%d %H:%M")
-                                timestamp = int(dt.timestamp()) + i  # 即使解析成功也要加上索引确保唯一性
-                            except:
-                                timestamp = current_time + i  # 解析失败时使用递增时间戳
+                # hash相同的消息只保留第一条（与ux_messages_session_hash一致）
+                if msg_hash is not None:
+                    if msg_hash in seen_hashes:
+                        continue
+                    seen_hashes.add(msg_hash)
+
+                rows.append(_MessageRow(
+                    session_id=session_id,
+                    wxid=current_wxid,
+                    content=content,
+                    is_self=int(is_self),
+                    timestamp=timestamp,
+                    extra_data=extra_data,
+                    msg_type=message_type,
+                    sender=sender,
+                    attr=attr,
+                    original_time=str(msg_time),
+                    formatted_time=_format_timestamp(timestamp),
+                    hash=msg_hash
+                ))
 
-                        # 保存额外数据 - 只保存必要信息
-                        extra_data = {
-                            'message_type': 'time' if (sender == 'base' and attr == 'base') else 'text'
-                        }
+            except Exception as e:
+                # 单条消息解析失败不影响整批写入
+                logger.warning(f"保存单条消息失败: {e}")
+                continue
+
+        return rows
+
+    def _submit_message_save(self, contact_name: str, rows: List[_MessageRow], current_wxid: str,
+                             replace: bool = False):
+        """在保存线程中保存消息，同一联系人的后续读写会先等待它完成"""
+        with self._pending_saves_lock:
+            future = self._save_pool.submit(self._write_real_message_rows, rows, contact_name, current_wxid, replace)
+            self._pending_saves[contact_name] = future
+        future.add_done_callback(lambda f: self._finish_message_save(contact_name, f))
+        return future
+
+    def _finish_message_save(self, contact_name: str, future):
+        """后台保存完成回调"""
+        with self._pending_saves_lock:
+            if self._pending_saves.get(contact_name) is future:
+                del self._pending_saves[contact_name]
+        result = future.result()
+        if result.get("success"):
+            logger.info(f"✅ 后台保存完成: {contact_name}, {result.get('saved_count', 0)} 条消息")
+        else:
+            logger.error(f"❌ 后台保存消息失败: {contact_name}, {result.get('message')}")
 
-                        # 根据实时消息的信息确定消息类型
-                        message_type = 'text'  # 默认为普通文本消息
+    def _wait_pending_save(self, contact_name: str):
+        """等待该联系人尚未完成的后台保存"""
+        with self._pending_saves_lock:
+            future = self._pending_saves.get(contact_name)
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"等待后台保存失败: {e}")
 
-                        # 检查是否为时间消息 - 根据sender和attr判断
-                        if sender == 'base' and attr == 'base' and msg_type == 'other':
-                            # 这很可能是时间分隔符消息
-                            message_type = 'time'
-                            extra_data['message_type'] = 'time'
-                        elif msg_type == 'system':
-                            message_type = 'system'
-                        else:
-                            message_type = msg_type
+    def _write_real_message_rows(self, rows: List[_MessageRow], contact_name: str, current_wxid: str,
+                                 replace: bool = False) -> Dict[str, Any]:
+        """批量写入消息行；replace为True时先清空该会话原有的消息，清空和写入在同一个事务中，失败时整体回滚"""
+        try:
+            if not rows:
+                return {"success": False, "message": "没有消息需要保存"}
 
-                        cursor.execute('''
-                        INSERT INTO messages (session_id, wxid, content, is_self, timestamp, extra_data, msg_type, sender, attr, original_time, formatted_time, hash)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            session_id,
-                            current_wxid,
-                            content,
-                            int(is_self),
-                            timestamp,
-                            json.dumps(extra_data),
-                            message_type,
-                            sender,
-                            attr,
-                            str(msg_time),
-                            datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"),
-                            msg_hash
-                        ))
+            session_id = _private_session_id(contact_name)
+            current_time = int(time.time())
 
-                        saved_count += 1
+            with self._get_db_connection() as conn:
+                cursor = conn.cursor()
 
-                    except Exception as e:
-                        logger.warning(f"保存单条消息失败: {e}")
-                        continue
+                # 创建会话记录（如果不存在）
+                cursor.execute(SQL_UPSERT_SESSION,
+                               (session_id, current_wxid, contact_name, 'private', current_time, current_time, current_time, 'friend'))
+
+                if replace:
+                    cursor.execute("DELETE FROM messages WHERE session_id = ? AND wxid = ?", (session_id, current_wxid))
+                    logger.info(f"已删除会话 {session_id} 的 {cursor.rowcount} 条旧消息")
+                    cursor.execute(
+                        "UPDATE sessions SET has_more_messages = 1, updated_at = ? WHERE session_id = ? AND wxid = ?",
+                        (current_time, session_id, current_wxid))
+
+                # 大批量导入时先删除二级索引，写完后一次性重建；
+                # 重建会扫描整张表，所以只在本批数据占表中大部分时才这样做
+                rebuild_index = False
+                if len(rows) > BULK_LOAD_INDEX_THRESHOLD:
+                    existing_count = cursor.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+                    rebuild_index = len(rows) >= existing_count
+                if rebuild_index:
+                    cursor.execute("DROP INDEX IF EXISTS idx_messages_session_wxid_id")
+                    cursor.execute("DROP INDEX IF EXISTS idx_messages_session_wxid_ts")
+
+                # 实测 executemany 比序列化成JSON后用 INSERT ... SELECT FROM json_each(?) 一条语句写入
+                # 快约1.8倍（200/2000/20000条均如此），JSON编码和解析的开销超过了逐行绑定参数
+                # 超大批量分块写入，每块一次executemany
+                saved_count = 0  # 不含因hash重复被忽略的行
+                for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+                    cursor.executemany(SQL_INSERT_MESSAGE, rows[start:start + BULK_INSERT_CHUNK_SIZE])
+                    saved_count += cursor.rowcount
+
+                if rebuild_index:
+                    cursor.execute(SQL_CREATE_MESSAGES_SESSION_INDEX)
+                    cursor.execute(SQL_CREATE_MESSAGES_TIMESTAMP_INDEX)
 
                 conn.commit()
                 logger.info(f"✅ 成功保存 {saved_count} 条真实消息")
+
+                if saved_count > BULK_LOAD_ANALYZE_THRESHOLD:
+                    # 会话数据整体重写后统计信息会过时，按采样方式快速重新分析
+                    cursor.execute("PRAGMA analysis_limit=1000")
+                    cursor.execute("ANALYZE messages")
                 return {"success": True, "saved_count": saved_count}
 
         except Exception as e:
@@ -3086,6 +3722,7 @@ class WxAutoBridge:
                     "auto_reply": auto_reply,  # 使用布尔值
                     "active": True
                 }
+                self._refresh_monitored_names()
                 
                 # 更新数据库中的监听状态
                 current_time = int(time.time())
@@ -3094,11 +3731,8 @@ class WxAutoBridge:
                     with self._get_db_connection() as conn:
                         cursor = conn.cursor()
                         # 写入/更新 sessions 表，is_monitoring=1
-                        session_id = f"private_self_{contact_name}"
-                        cursor.execute('''
-                            INSERT OR REPLACE INTO sessions (session_id, wxid, name, type, last_time, created_at, updated_at, chat_type, is_monitoring)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (
+                        session_id = _private_session_id(contact_name)
+                        cursor.execute(SQL_UPSERT_SESSION_MONITORING, (
                             session_id,
                             current_wxid,
                             contact_name,
@@ -3111,21 +3745,22 @@ class WxAutoBridge:
                         ))
                         conn.commit()
                 except Exception as e:
-                    logger.error(f"更新数据库监听状态失败: {e}")
-                    logger.error(traceback.format_exc())
+                    logger.exception("更新数据库监听状态失败: %s", e)
                 
                 # 确保监听线程已启动
                 if not self.is_monitoring or not self.monitoring_thread or not self.monitoring_thread.is_alive():
                     logger.info("监听线程未启动，正在启动...")
                     self._start_monitoring_thread()
+                else:
+                    # 线程已在运行，唤醒它立即开始拉取新联系人的消息
+                    self._monitor_wake.set()
                 
             return {
                 "success": True,
                 "message": f"Started monitoring {contact_name}"
             }
         except Exception as e:
-            logger.error(f"启动监听失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("启动监听失败: %s", e)
             return {"success": False, "message": str(e)}
     
     def stop_monitoring(self, contact_name: str) -> Dict[str, Any]:
@@ -3137,6 +3772,7 @@ class WxAutoBridge:
                 # 更新内存中的监听状态
                 if contact_name in self.monitored_contacts:
                     del self.monitored_contacts[contact_name]
+                    self._refresh_monitored_names()
                     # 更新数据库中的监听状态
                     current_time = int(time.time())
                     try:
@@ -3144,19 +3780,17 @@ class WxAutoBridge:
                         with self._get_db_connection() as conn:
                             cursor = conn.cursor()
                             # 更新 sessions 表，is_monitoring=0
-                            session_id = f"private_self_{contact_name}"
-                            cursor.execute('''
-                                UPDATE sessions SET is_monitoring = 0, updated_at = ?, last_time = ? 
-                                WHERE session_id = ? AND wxid = ?
-                            ''', (current_time, current_time, session_id, current_wxid))
+                            session_id = _private_session_id(contact_name)
+                            cursor.execute(SQL_STOP_SESSION_MONITORING,
+                                           (current_time, current_time, session_id, current_wxid))
                             conn.commit()
                     except Exception as e:
-                        logger.error(f"更新数据库监听状态失败: {e}")
-                        logger.error(traceback.format_exc())
+                        logger.exception("更新数据库监听状态失败: %s", e)
                     
                     # 如果没有监听的联系人了，停止监听线程
                     if not self.monitored_contacts and self.monitoring_thread:
                         self.is_monitoring = False
+                        self._monitor_wake.set()  # 立即唤醒监听线程，使其退出循环
                         self.monitoring_thread.join(timeout=1)
                         self.monitoring_thread = None
                         logger.info("所有监听已停止")
@@ -3166,8 +3800,7 @@ class WxAutoBridge:
                 "message": f"Stopped monitoring {contact_name}"
             }
         except Exception as e:
-            logger.error(f"停止监听失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("停止监听失败: %s", e)
             return {"success": False, "message": str(e)}
     
     def get_auto_reply_status(self) -> Dict[str, Any]:
@@ -3193,8 +3826,7 @@ class WxAutoBridge:
                 }
             }
         except Exception as e:
-            logger.error(f"❌ 获取自动回复状态失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("❌ 获取自动回复状态失败: %s", e)
             return {"success": False, "message": str(e)}
     
     def toggle_auto_reply(self, enabled: bool) -> Dict[str, Any]:
@@ -3207,20 +3839,7 @@ class WxAutoBridge:
             # 使用新的数据库连接
             with self._get_db_connection() as conn:
                 cursor = conn.cursor()
-                # 查询是否已有配置
-                cursor.execute('SELECT id FROM ai_sales_config WHERE wxid = ?', (current_wxid,))
-                row = cursor.fetchone()
-                if row:
-                    # 已有配置，更新
-                    cursor.execute('''
-                        UPDATE ai_sales_config SET auto_reply_enabled = ?, updated_at = ? WHERE wxid = ?
-                    ''', (int(enabled), current_time, current_wxid))
-                else:
-                    # 没有配置，插入
-                    cursor.execute('''
-                        INSERT INTO ai_sales_config (wxid, auto_reply_enabled, created_at, updated_at)
-                        VALUES (?, ?, ?, ?)
-                    ''', (current_wxid, int(enabled), current_time, current_time))
+                self._upsert_ai_sales_config(cursor, current_wxid, {"auto_reply_enabled": int(enabled)}, current_time)
                 conn.commit()
                 
             return {
@@ -3228,8 +3847,7 @@ class WxAutoBridge:
                 "message": f"Auto reply {'enabled' if enabled else 'disabled'} and saved to db"
             }
         except Exception as e:
-            logger.error(f"Failed to toggle auto reply: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Failed to toggle auto reply: %s", e)
             return {"success": False, "message": str(e)}
 
     def __del__(self):
@@ -3252,22 +3870,76 @@ class WxAutoBridge:
                 except Exception as e:
                     logger.error(f"停止消息处理线程时出错: {e}")
             
+            # 停止自动回复发送线程（先发送完已入队的回复）
+            if self._reply_sender_thread and self._reply_sender_thread.is_alive():
+                try:
+                    self._reply_queue.put(None)
+                    self._reply_sender_thread.join(timeout=1)
+                except Exception as e:
+                    logger.error(f"停止自动回复发送线程时出错: {e}")
+
             # 停止监听
             self.is_monitoring = False
+            self._monitor_wake.set()
             if self.monitoring_thread and self.monitoring_thread.is_alive():
                 try:
                     self.monitoring_thread.join(timeout=1)
                 except Exception as e:
                     logger.error(f"停止监听线程时出错: {e}")
             
+            # 等待后台保存完成，再关闭线程池和数据库连接
+            with self._pending_saves_lock:
+                pending_saves = list(self._pending_saves.values())
+            for future in pending_saves:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"等待后台保存失败: {e}")
+
             # 关闭线程池
             try:
                 self.thread_pool.shutdown(wait=False)
+                self._save_pool.shutdown(wait=False)
             except Exception as e:
                 logger.error(f"关闭线程池时出错: {e}")
+
+            # 关闭数据库连接
+            try:
+                self._close_db_connections()
+            except Exception as e:
+                logger.error(f"关闭数据库连接时出错: {e}")
+
+            # 关闭HTTP会话
+            try:
+                self._http.close()
+            except Exception as e:
+                logger.error(f"关闭HTTP会话时出错: {e}")
         except Exception as e:
-            logger.error(f"清理资源时发生错误: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("清理资源时发生错误: %s", e)
+
+    def _upsert_ai_sales_config(self, cursor, wxid: str, fields: Dict[str, Any], current_time: int):
+        """写入AI销冠配置：已有配置只更新fields中的字段，没有配置时按默认值插入"""
+        values = {**AI_SALES_CONFIG_DEFAULTS, **fields}
+        insert_columns = ["wxid", *AI_SALES_CONFIG_FIELDS, "created_at", "updated_at"]
+        insert_values = (wxid, *(values.get(column) for column in AI_SALES_CONFIG_FIELDS), current_time, current_time)
+        update_columns = [*fields, "updated_at"]
+
+        if SQLITE_SUPPORTS_UPSERT and self._ai_config_unique:
+            cursor.execute(f'''
+                INSERT INTO ai_sales_config ({", ".join(insert_columns)})
+                VALUES ({", ".join("?" * len(insert_columns))})
+                ON CONFLICT(wxid) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in update_columns)}
+            ''', insert_values)
+        else:
+            # 旧版SQLite或没有唯一索引：先更新，没有命中再插入
+            cursor.execute(f'''
+                UPDATE ai_sales_config SET {", ".join(f"{c} = ?" for c in update_columns)} WHERE wxid = ?
+            ''', (*fields.values(), current_time, wxid))
+            if cursor.rowcount == 0:
+                cursor.execute(f'''
+                    INSERT INTO ai_sales_config ({", ".join(insert_columns)})
+                    VALUES ({", ".join("?" * len(insert_columns))})
+                ''', insert_values)
 
     def get_ai_sales_config(self) -> Dict[str, Any]:
         """获取AI销冠配置"""
@@ -3313,8 +3985,7 @@ class WxAutoBridge:
                         }
                     }
         except Exception as e:
-            logger.error(f"❌ 获取AI销冠配置失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("❌ 获取AI销冠配置失败: %s", e)
             return {"success": False, "message": str(e)}
 
     def update_ai_sales_config(self, config: Dict[str, Any]) -> Dict[str, Any]:
@@ -3323,53 +3994,29 @@ class WxAutoBridge:
             current_wxid = self.get_current_wxid()
             logger.info(f"🔄 更新用户 {current_wxid} 的AI销冠配置")
             
-            # 获取当前配置
-            current_config = self.get_ai_sales_config()
-            if not current_config["success"]:
-                return current_config
-            
-            # 合并配置
-            current_data = current_config["data"]
-            current_data.update(config)
-            
-            # 更新时间
+            # 只写入调用方传入的字段，其余字段保持不变
+            fields = {k: v for k, v in config.items() if k in AI_SALES_CONFIG_FIELDS}
+            if fields.get("api_key") == "******":
+                # 前端回传的是脱敏后的占位符，不能覆盖真实的api_key
+                del fields["api_key"]
+
             current_time = int(time.time())
-            current_data["updated_at"] = current_time
-            
-            # 如果是新配置，设置创建时间
-            if not current_data.get("created_at"):
-                current_data["created_at"] = current_time
-            
+
             # 更新数据库
             try:
                 # 使用新的数据库连接
                 with self._get_db_connection() as conn:
                     cursor = conn.cursor()
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO ai_sales_config 
-                        (wxid, api_key, api_url, model_name, temperature, max_tokens, 
-                         system_prompt, auto_reply_prompt, reply_suggest_prompt, 
-                         auto_reply_enabled, reply_suggest_enabled,
-                         created_at, updated_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        current_wxid,
-                        current_data.get("api_key"),
-                        current_data.get("api_url"),
-                        current_data.get("model_name", "gpt-3.5-turbo"),
-                        current_data.get("temperature", 0.7),
-                        current_data.get("max_tokens", 2000),
-                        current_data.get("system_prompt"),
-                        current_data.get("auto_reply_prompt"),
-                        current_data.get("reply_suggest_prompt"),
-                        current_data.get("auto_reply_enabled", False),
-                        current_data.get("reply_suggest_enabled", False),
-                        current_data.get("created_at"),
-                        current_data.get("updated_at")
-                    ))
+                    self._upsert_ai_sales_config(cursor, current_wxid, fields, current_time)
                     conn.commit()
                     logger.info("✅ AI销冠配置已更新")
-                
+
+                    # 在同一连接中读回更新后的配置
+                    cursor.execute('''
+                        SELECT * FROM ai_sales_config WHERE wxid = ?
+                    ''', (current_wxid,))
+                    current_data = dict(cursor.fetchone())
+
                 # 返回更新后的配置（隐藏敏感信息）
                 current_data["api_key"] = "******" if current_data.get("api_key") else None
                 return {
@@ -3377,13 +4024,11 @@ class WxAutoBridge:
                     "data": current_data
                 }
             except Exception as e:
-                logger.error(f"❌ 更新数据库失败: {e}")
-                logger.error(traceback.format_exc())
+                logger.exception("❌ 更新数据库失败: %s", e)
                 return {"success": False, "message": str(e)}
                 
         except Exception as e:
-            logger.error(f"❌ 更新AI销冠配置失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("❌ 更新AI销冠配置失败: %s", e)
             return {"success": False, "message": str(e)}
 
     def delete_ai_sales_config(self) -> Dict[str, Any]:
@@ -3406,14 +4051,13 @@ class WxAutoBridge:
                 "message": "AI销冠配置已删除"
             }
         except Exception as e:
-            logger.error(f"❌ 删除AI销冠配置失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("❌ 删除AI销冠配置失败: %s", e)
             return {"success": False, "message": str(e)}
 
     def get_session_monitoring_status(self, contact_name: str) -> Dict[str, Any]:
         """获取指定联系人的监听状态（is_monitoring）"""
         try:
-            session_id = f"private_self_{contact_name}"
+            session_id = _private_session_id(contact_name)
             current_wxid = self.get_current_wxid()
             
             # 使用新的数据库连接
@@ -3424,8 +4068,7 @@ class WxAutoBridge:
                 is_monitoring = bool(row['is_monitoring']) if row and row['is_monitoring'] is not None else False
             return {"success": True, "is_monitoring": is_monitoring}
         except Exception as e:
-            logger.error(f"❌ 获取监听状态失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("❌ 获取监听状态失败: %s", e)
             return {"success": False, "message": str(e)}
 
     def _start_monitoring_thread(self):
@@ -3434,9 +4077,47 @@ class WxAutoBridge:
             logger.info("🚀 消息监听线程已启动 - 开始监听微信消息")
             logger.info(f"💡 当前监听的联系人: {list(self.monitored_contacts.keys())}")
             
-            # 消息ID缓存，用于避免重复处理消息
+            # 消息ID缓存，用于避免重复处理消息（联系人 -> 按插入顺序淘汰的OrderedDict）
             message_id_cache = {}
+            dedup_hits = 0  # 被判定为重复而跳过的消息数
             loop_count = 0
+
+            # 按距上次收到消息的时间调整轮询间隔：刚收到消息时密集轮询，空闲越久间隔越长
+            last_msg_ts = 0.0
+            # 连续出错时的等待时间依次为1、2、5秒，之后保持5秒
+            error_delays = (1, 2, 5)
+            error_count = 0
+            last_idle_log = time.monotonic()  # 上次输出空闲日志的时间
+
+            def idle(timeout):
+                """等待timeout秒，启动/停止监听时会被提前唤醒"""
+                if self._monitor_wake.wait(timeout):
+                    self._monitor_wake.clear()
+
+            def poll_interval():
+                """根据距上次收到消息的时间返回轮询间隔"""
+                since_last = time.monotonic() - last_msg_ts
+                if since_last < 1.0:
+                    return 0.05
+                if since_last < 10.0:
+                    return 0.2
+                return 1.0
+
+            def error_delay():
+                """返回本次出错后的等待时间，连续出错时逐步拉长"""
+                nonlocal error_count
+                delay = error_delays[min(error_count, len(error_delays) - 1)]
+                error_count += 1
+                return delay
+
+            def should_log_idle():
+                """空闲日志每5分钟最多输出一次"""
+                nonlocal last_idle_log
+                now = time.monotonic()
+                if now - last_idle_log >= 300:
+                    last_idle_log = now
+                    return True
+                return False
             
             # 添加调试日志，确认线程进入while循环
             logger.info("⚙️ 监听线程准备进入循环...")
@@ -3444,25 +4125,28 @@ class WxAutoBridge:
             try:
                 logger.info("🔄 监听线程第一次循环开始")
                 
-                while True:
+                while self.is_monitoring:
                     try:
+                        # 逐条消息的详细日志只在DEBUG级别输出，先判断一次，避免无用的字符串格式化
+                        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
                         # 添加调试日志，确认循环正在执行
-                        if loop_count == 0 or loop_count % 20 == 0:
-                            logger.info(f"🔄 监听线程循环执行中 - 第{loop_count+1}次")
+                        if debug_enabled and loop_count % 20 == 0:
+                            logger.debug("🔄 监听线程循环执行中 - 第%d次", loop_count + 1)
                         
                         loop_count += 1
                                                 
-                        # 检查是否有联系人需要监听
-                        if not self.monitored_contacts:
-                            if loop_count % 300 == 0:  # 每300次循环记录一次
+                        # 没有联系人需要监听时不拉取消息，长时间等待（开始监听时会立即唤醒）
+                        if not self._monitored_names:
+                            if should_log_idle():
                                 logger.info("⏸️ 没有联系人需要监听，监听线程等待中...")
-                            time.sleep(1)
+                            idle(5)
                             continue
                         
                         # 检查微信客户端是否可用
                         if not self.wechat_client or not self.is_connected:
                             logger.info("⚠️ 微信客户端未连接，暂停监听")
-                            time.sleep(3)
+                            idle(3)
                             continue
                         
                         # 直接获取新消息，不需要切换聊天窗口
@@ -3470,126 +4154,140 @@ class WxAutoBridge:
                             try:
                                 # 尝试调用GetNextNewMessage方法
                                 try:
-                                    messagesObject = self.wechat_client.GetNextNewMessage(filter_mute=True)
+                                    messagesObject = self._get_next_new_message(filter_mute=True)
+                                    error_count = 0
                                     if not messagesObject:
+                                        # 没有新消息，按空闲时长等待
+                                        idle(poll_interval())
                                         continue
+                                    last_msg_ts = time.monotonic()
                                     
                                     messages = messagesObject.get("msg")
                                     chat_name = messagesObject.get("chat_name")
                                     chat_type = messagesObject.get("chat_type")
-                                    logger.info(f"从字典获取消息: chat_name={chat_name}, chat_type={chat_type}, messages={messages}")
-                                        
-                                    logger.info(f"📥 GetNextNewMessage返回结果: {chat_name} {chat_type} {messages}")
+                                    if debug_enabled:
+                                        logger.debug("📥 GetNextNewMessage返回结果: chat_name=%s, chat_type=%s, messages=%s",
+                                                     chat_name, chat_type, messages)
                                 except Exception as e:
-                                    logger.info(f"❌ GetNextNewMessage调用异常: {e}")
-                                    logger.info(traceback.format_exc())
+                                    logger.info("❌ GetNextNewMessage调用异常: %s", e, exc_info=True)
                                     
-                                    # 尝试获取可用的方法
-                                    if self.wechat_client:
+                                    # 尝试获取可用的方法（只在第一次失败时输出）
+                                    if self.wechat_client and not self._methods_logged:
                                         methods = [m for m in dir(self.wechat_client) if not m.startswith('_') and callable(getattr(self.wechat_client, m))]
                                         logger.info(f"可用的微信客户端方法: {methods}")
+                                        self._methods_logged = True
                                     
-                                    time.sleep(2)
+                                    idle(error_delay())
                                     continue
                             except Exception as e:
-                                logger.info(f"❌ GetNextNewMessage调用异常: {e}")
-                                logger.info(traceback.format_exc())
-                                time.sleep(2)
+                                logger.info("❌ GetNextNewMessage调用异常: %s", e, exc_info=True)
+                                idle(error_delay())
                                 continue
                             
-                            # 处理消息
-                            if messages:
-                                logger.info(f"📝 收到{len(messages)}条新消息")
+                            # 处理消息（拉取期间监听名单被清空时，直接丢弃本轮消息）
+                            monitored_names = self._monitored_names
+                            if messages and monitored_names:
                                 # 确保messages是列表
                                 if not isinstance(messages, list):
                                     messages = [messages]
-                                    logger.info(f"📝 收到单条消息，转换为列表: {type(messages)}")
-                                else:
-                                    logger.info(f"📝 收到{len(messages)}条新消息")
+                                logger.info("📝 收到%d条新消息", len(messages))
                                 
                                 # 处理消息...
-                                # 这部分代码保持不变
-                                for message in messages:
+                                # 本轮的新消息先收集起来，最后一次性放入队列
+                                batch = []
+                                # 先一次性取出各条消息的字段（缺少的属性用默认值）
+                                rows = [
+                                    _MonitoredMessage(getattr(m, 'sender', None), getattr(m, 'content', ''),
+                                                      getattr(m, 'time', ''), getattr(m, 'attr', None))
+                                    for m in messages
+                                ]
+                                for message, row in zip(messages, rows):
                                     try:
-                                        # 获取消息发送者
-                                        sender_name = None
-                                        if hasattr(message, 'sender'):
-                                            sender_name = message.sender
-                                            logger.info(f"👤 消息发送者: {sender_name}")
+                                        sender_name = row.sender
+                                        if debug_enabled:
+                                            logger.debug("👤 消息发送者: %s", sender_name)
                                         
                                         # 检查发送者是否在监听列表中
-                                        if sender_name in self.monitored_contacts:
-                                            logger.info(f"✅ 发现监听联系人 {sender_name} 的消息")
+                                        if sender_name in monitored_names:
+                                            if debug_enabled:
+                                                logger.debug("✅ 发现监听联系人 %s 的消息", sender_name)
                                             
                                             # 生成消息唯一ID
-                                            content = getattr(message, 'content', '')
-                                            msg_time = getattr(message, 'time', '')
-                                            attr = getattr(message, 'attr', '')
-                                            msg_id = f"{sender_name}:{content[:20]}:{msg_time}"
+                                            content = row.content
+                                            msg_time = row.time
+                                            attr = row.attr
+                                            # 按加盐的完整内容和时间计算64位指纹，避免前缀相同的消息互相冲突，缓存中只存整数
+                                            msg_id = int.from_bytes(hashlib.blake2b(
+                                                self._dedup_salt + content.encode('utf-8', 'ignore') + b'\0' + str(msg_time).encode(),
+                                                digest_size=8).digest(), 'little')
                                             
-                                            logger.info(f"📋 消息详情 - 内容: '{content[:30]}...', 时间: {msg_time}, 属性: {attr}")
+                                            if debug_enabled:
+                                                logger.debug("📋 消息详情 - 内容: '%s...', 时间: %s, 属性: %s",
+                                                             content[:30], msg_time, attr)
                                             
                                             # 初始化联系人的消息缓存
-                                            if sender_name not in message_id_cache:
-                                                message_id_cache[sender_name] = set()
-                                                logger.info(f"🆕 为联系人 {sender_name} 创建消息缓存")
+                                            sender_cache = message_id_cache.get(sender_name)
+                                            if sender_cache is None:
+                                                sender_cache = message_id_cache[sender_name] = OrderedDict()
+                                                if debug_enabled:
+                                                    logger.debug("🆕 为联系人 %s 创建消息缓存", sender_name)
                                             
                                             # 检查是否是新消息（非自己发送的且未处理过）
-                                            if (hasattr(message, 'attr') and message.attr != 'self' and 
-                                                msg_id not in message_id_cache[sender_name]):
+                                            if attr is not None and attr != 'self' and msg_id not in sender_cache:
                                                 
-                                                # 将消息放入队列处理
-                                                self.message_queue.put((sender_name, message))
-                                                logger.info(f"📨 收到来自 {sender_name} 的新消息: {content[:30]}...")
+                                                # 加入本轮批次，稍后统一放入队列处理
+                                                batch.append((sender_name, message))
+                                                logger.info("📨 收到来自 %s 的新消息: %s...", sender_name, content[:30])
                                                 
                                                 # 添加到缓存，避免重复处理
-                                                message_id_cache[sender_name].add(msg_id)
-                                                logger.info(f"📌 消息ID已添加到缓存，当前缓存大小: {len(message_id_cache[sender_name])}")
+                                                sender_cache[msg_id] = None
+                                                if debug_enabled:
+                                                    logger.debug("📌 消息ID已添加到缓存，当前缓存大小: %d", len(sender_cache))
                                                 
-                                                # 限制缓存大小
-                                                if len(message_id_cache[sender_name]) > 100:
-                                                    old_size = len(message_id_cache[sender_name])
-                                                    # 保留最新的50条
-                                                    message_id_cache[sender_name] = set(list(message_id_cache[sender_name])[-50:])
-                                                    logger.info(f"🧹 清理消息缓存: {old_size} -> {len(message_id_cache[sender_name])}")
+                                                # 限制缓存大小，超出时淘汰最早的一条
+                                                if len(sender_cache) > MONITOR_DEDUP_CACHE_SIZE:
+                                                    sender_cache.popitem(last=False)
                                             else:
-                                                if message.attr == 'self':
-                                                    logger.info(f"🚫 跳过自己发送的消息")
-                                                elif msg_id in message_id_cache[sender_name]:
-                                                    logger.info(f"🔄 跳过重复消息: {content[:20]}...")
+                                                if attr == 'self':
+                                                    if debug_enabled:
+                                                        logger.debug("🚫 跳过自己发送的消息")
+                                                elif msg_id in sender_cache:
+                                                    dedup_hits += 1
+                                                    if debug_enabled:
+                                                        logger.debug("🔄 跳过重复消息: %s... (累计跳过 %d 条)", content[:20], dedup_hits)
                                                 else:
-                                                    logger.info(f"⏭️ 跳过不符合条件的消息")
+                                                    if debug_enabled:
+                                                        logger.debug("⏭️ 跳过不符合条件的消息")
                                         else:
-                                            if sender_name:
-                                                logger.debug(f"❌ 发送者 {sender_name} 不在监听列表中，跳过")
+                                            if debug_enabled and sender_name:
+                                                logger.debug("❌ 发送者 %s 不在监听列表中，跳过", sender_name)
                                     except Exception as msg_error:
-                                        logger.error(f"❗ 处理单条消息失败: {msg_error}")
-                                        logger.error(traceback.format_exc())
+                                        logger.exception("❗ 处理单条消息失败: %s", msg_error)
+                                if batch:
+                                    self.message_queue.put(batch)
                             else:
-                                if loop_count % 300 == 0:  # 每300次循环记录一次
+                                if should_log_idle():
                                     logger.debug("🔄 没有新消息")
                         except Exception as inner_e:
-                            logger.error(f"❌ 获取消息过程中发生异常: {inner_e}")
-                            logger.error(traceback.format_exc())
-                            time.sleep(2)  # 出错后暂停一段时间
+                            logger.exception("❌ 获取消息过程中发生异常: %s", inner_e)
+                            idle(error_delay())  # 出错后暂停一段时间，连续出错时逐步拉长
                             continue
                         
-                        # 监听间隔
-                        time.sleep(1)
+                        # 监听间隔（刚收到消息，短暂等待后继续拉取）
+                        idle(poll_interval())
                         
                     except Exception as e:
-                        logger.error(f"❌ 消息监听线程循环内异常: {e}")
-                        logger.error(traceback.format_exc())
-                        time.sleep(5)  # 出错后暂停一段时间
+                        logger.exception("❌ 消息监听线程循环内异常: %s", e)
+                        idle(error_delay())  # 出错后暂停一段时间
                 
             except Exception as outer_e:
-                logger.error(f"❌❌❌ 监听线程主循环异常: {outer_e}")
-                logger.error(traceback.format_exc())
+                logger.exception("❌❌❌ 监听线程主循环异常: %s", outer_e)
             
             logger.info("🛑 消息监听线程已停止")
         
         # 启动监听线程
         self.is_monitoring = True
+        self._monitor_wake.clear()
         # 确保线程为daemon线程，这样主程序退出时线程会自动终止
         self.monitoring_thread = threading.Thread(target=monitor_messages, daemon=True)
         self.monitoring_thread.start()
@@ -3617,14 +4315,10 @@ class WxAutoBridge:
             
             # 查询所有is_monitoring=1的会话
             with self._get_db_connection() as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                cursor.execute('''
+                rows = conn.execute('''
                     SELECT session_id, name FROM sessions 
                     WHERE wxid = ? AND is_monitoring = 1
-                ''', (current_wxid,))
-                
-                rows = cursor.fetchall()
+                ''', (current_wxid,)).fetchall()
                 restored_count = 0
                 
                 for row in rows:
@@ -3632,10 +4326,8 @@ class WxAutoBridge:
                         session_id = row['session_id']
                         name = row['name']
                         
-                        # 从session_id中提取联系人名称
-                        if session_id.startswith('private_self_'):
-                            contact_name = session_id[13:]  # 移除 'private_self_' 前缀
-                        else:
+                        # 从session_id中提取联系人名称，不是私聊会话时使用会话名称
+                        if (contact_name := session_id.removeprefix(PRIVATE_SESSION_PREFIX)) == session_id:
                             contact_name = name
                         
                         if contact_name:
@@ -3647,26 +4339,23 @@ class WxAutoBridge:
                             restored_count += 1
                             logger.info(f"已恢复监听状态: {contact_name}")
                     except Exception as e:
-                        logger.error(f"恢复单个联系人监听状态失败: {e}")
-                        logger.error(traceback.format_exc())
+                        logger.exception("恢复单个联系人监听状态失败: %s", e)
+                self._refresh_monitored_names()
                 
                 logger.info(f"共恢复了 {restored_count} 个联系人的监听状态")
                 
                 # 获取自动回复状态
                 try:
-                    cursor = conn.cursor()
-                    cursor.execute('SELECT auto_reply_enabled FROM ai_sales_config WHERE wxid = ?', (current_wxid,))
-                    row = cursor.fetchone()
+                    row = conn.execute('SELECT auto_reply_enabled FROM ai_sales_config WHERE wxid = ?',
+                                       (current_wxid,)).fetchone()
                     if row and row['auto_reply_enabled'] is not None:
                         self.auto_reply_enabled = bool(row['auto_reply_enabled'])
                         logger.info(f"已恢复自动回复状态: {self.auto_reply_enabled}")
                 except Exception as e:
-                    logger.error(f"恢复自动回复状态失败: {e}")
-                    logger.error(traceback.format_exc())
+                    logger.exception("恢复自动回复状态失败: %s", e)
         
         except Exception as e:
-            logger.error(f"恢复监听状态失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("恢复监听状态失败: %s", e)
 
     def _save_reply_suggestion(self, session_id: str, content: str, message_id: int, contact_name: str = None) -> bool:
         """保存回复建议到reply_suggestions表
@@ -3683,13 +4372,12 @@ class WxAutoBridge:
         try:
             current_wxid = self.get_current_wxid()
             timestamp = int(time.time())
-            created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            created_at = _format_timestamp(timestamp)
             
             # 如果没有提供contact_name，则从session_id中提取
-            if not contact_name and session_id.startswith("private_self_"):
-                contact_name = session_id[13:]  # 移除 'private_self_' 前缀
-            elif not contact_name:
-                contact_name = session_id  # 如果无法提取，则使用session_id作为chat_name
+            if not contact_name:
+                # 移除私聊前缀，无法提取时直接使用session_id作为chat_name
+                contact_name = session_id.removeprefix(PRIVATE_SESSION_PREFIX)
             
             logger.info(f"保存回复建议 - 会话ID: {session_id}, 消息ID: {message_id}, 联系人: {contact_name}")
             
@@ -3698,8 +4386,7 @@ class WxAutoBridge:
                 cursor = conn.cursor()
                 
                 # 检查表是否存在
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='reply_suggestions'")
-                if not cursor.fetchone():
+                if not self._table_exists(cursor, "reply_suggestions"):
                     logger.error("reply_suggestions表不存在，尝试创建")
                     cursor.execute('''
                         CREATE TABLE IF NOT EXISTS reply_suggestions (
@@ -3715,7 +4402,9 @@ class WxAutoBridge:
                             FOREIGN KEY (message_id) REFERENCES messages (id)
                         )
                     ''')
+                    cursor.execute(SQL_CREATE_REPLY_SUGGESTIONS_INDEX)
                     conn.commit()
+                    self._known_tables.add("reply_suggestions")
                     logger.info("✅ 成功创建reply_suggestions表")
                 
                 # 检查消息是否存在
@@ -3757,8 +4446,7 @@ class WxAutoBridge:
                     
                     return True
                 except Exception as insert_error:
-                    logger.error(f"插入回复建议失败: {insert_error}")
-                    logger.error(traceback.format_exc())
+                    logger.exception("插入回复建议失败: %s", insert_error)
                     
                     # 检查表结构
                     cursor.execute("PRAGMA table_info(reply_suggestions)")
@@ -3767,8 +4455,7 @@ class WxAutoBridge:
                     
                     return False
         except Exception as e:
-            logger.error(f"保存回复建议失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("保存回复建议失败: %s", e)
             return False
 
     def get_reply_suggestions(self, session_id: str, limit: int = 10) -> Dict[str, Any]:
@@ -3790,14 +4477,12 @@ class WxAutoBridge:
                 cursor = conn.cursor()
                 
                 # 检查表是否存在
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='reply_suggestions'")
-                if not cursor.fetchone():
+                if not self._table_exists(cursor, "reply_suggestions"):
                     logger.warning("reply_suggestions表不存在")
                     return {"success": False, "message": "reply_suggestions表不存在"}
                 
                 # 检查表结构
-                cursor.execute("PRAGMA table_info(reply_suggestions)")
-                columns = [column[1] for column in cursor.fetchall()]
+                columns = self._get_table_columns(cursor, "reply_suggestions")
                 logger.info(f"reply_suggestions表结构: {columns}")
                 
                 # 查询回复建议，并关联原始消息
@@ -3815,8 +4500,7 @@ class WxAutoBridge:
                     rows = cursor.fetchall()
                     logger.info(f"查询到 {len(rows)} 条回复建议")
                 except Exception as e:
-                    logger.error(f"查询回复建议失败: {e}")
-                    logger.error(traceback.format_exc())
+                    logger.exception("查询回复建议失败: %s", e)
                     return {"success": False, "message": f"查询回复建议失败: {str(e)}"}
                 
                 suggestions = []
@@ -3831,7 +4515,7 @@ class WxAutoBridge:
                         "used": bool(row[5]),
                         "original_content": row[6],
                         "original_timestamp": row[7],
-                        "formatted_time": datetime.fromtimestamp(row[3]).strftime("%Y-%m-%d %H:%M:%S")
+                        "formatted_time": _format_timestamp(row[3])
                     }
                     suggestions.append(suggestion)
                 
@@ -3844,8 +4528,7 @@ class WxAutoBridge:
                     }
                 }
         except Exception as e:
-            logger.error(f"获取回复建议失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("获取回复建议失败: %s", e)
             return {"success": False, "message": str(e)}
 
     def mark_suggestion_as_used(self, suggestion_id: int) -> Dict[str, Any]:
@@ -3880,8 +4563,7 @@ class WxAutoBridge:
                     return {"success": False, "message": "回复建议不存在"}
                 
         except Exception as e:
-            logger.error(f"标记回复建议失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("标记回复建议失败: %s", e)
             return {"success": False, "message": str(e)}
 
     def delete_old_suggestions(self) -> Dict[str, Any]:
@@ -3898,24 +4580,16 @@ class WxAutoBridge:
             with self._get_db_connection() as conn:
                 cursor = conn.cursor()
                 
-                # 查询suggestion类型的消息数量
+                # 直接删除suggestion类型的消息，用rowcount得到删除条数（不再先COUNT）
                 cursor.execute('''
-                    SELECT COUNT(*) FROM messages 
+                    DELETE FROM messages 
                     WHERE msg_type = 'suggestion' AND wxid = ?
                 ''', (current_wxid,))
+                deleted_count = cursor.rowcount
+                logger.info(f"找到 {deleted_count} 条suggestion类型消息")
                 
-                count = cursor.fetchone()[0]
-                logger.info(f"找到 {count} 条suggestion类型消息")
-                
-                if count > 0:
-                    # 删除suggestion类型的消息
-                    cursor.execute('''
-                        DELETE FROM messages 
-                        WHERE msg_type = 'suggestion' AND wxid = ?
-                    ''', (current_wxid,))
-                    
+                if deleted_count > 0:
                     conn.commit()
-                    deleted_count = cursor.rowcount
                     logger.info(f"✅ 成功删除 {deleted_count} 条suggestion类型消息")
                     
                     return {
@@ -3931,12 +4605,12 @@ class WxAutoBridge:
                     }
                 
         except Exception as e:
-            logger.error(f"删除suggestion类型消息失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("删除suggestion类型消息失败: %s", e)
             return {"success": False, "message": str(e)}
 
     def call_openai_api_with_history(self, api_key: str, model: str, messages: List[Dict[str, str]], 
-                          temperature: float = 0.7, max_tokens: int = 2000, api_url: Optional[str] = None) -> Optional[str]:
+                          temperature: float = 0.7, max_tokens: int = 2000, api_url: Optional[str] = None,
+                          stream: bool = False, on_delta: Optional[Callable[[str], None]] = None) -> Optional[str]:
         """调用OpenAI API生成回复，支持传入完整的消息历史
         
         Args:
@@ -3946,6 +4620,8 @@ class WxAutoBridge:
             temperature: 温度参数
             max_tokens: 最大生成token数
             api_url: 可选的API URL，如果不提供则使用OpenAI默认地址
+            stream: 是否使用流式（SSE）响应
+            on_delta: 流式响应时，每收到一段内容就调用一次
             
         Returns:
             生成的回复内容，如果调用失败则返回None
@@ -3956,17 +4632,14 @@ class WxAutoBridge:
                 url = api_url
             else:
                 # 默认使用国内可访问的代理地址
-                url = "https://api.openai-proxy.com/v1/chat/completions"
+                url = DEFAULT_API_URL
                 # 其他可选的代理地址
                 # url = "https://openai.aihey.cc/openai/v1/chat/completions"
                 # url = "https://openai.wndbac.cn/v1/chat/completions"
                 # url = "https://proxy.geekai.co/v1/chat/completions"
             
             # 准备请求头
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
+            headers = _auth_headers(api_key)
             
             # 准备请求体
             data = {
@@ -3975,16 +4648,26 @@ class WxAutoBridge:
                 "temperature": temperature,
                 "max_tokens": max_tokens
             }
+            if stream:
+                data["stream"] = True
             
             logger.info(f"开始调用API: {url}")
             logger.info(f"消息数量: {len(messages)}")
             
             # 发送请求
-            response = requests.post(url, headers=headers, json=data, timeout=30)
+            response = self._http.post(url, headers=headers, data=_json_dumps_bytes(data), timeout=30, stream=stream)
             
             # 检查响应状态
             if response.status_code == 200:
-                response_data = response.json()
+                if stream:
+                    content = self._read_stream_content(response, on_delta)
+                    if content:
+                        logger.info("API流式调用成功，获取到回复内容")
+                        return content.strip()
+                    logger.warning("API返回内容为空")
+                    return None
+
+                response_data = _json_loads(response.content)
                 
                 # 提取生成的文本
                 if "choices" in response_data and len(response_data["choices"]) > 0:
@@ -4001,22 +4684,43 @@ class WxAutoBridge:
                     logger.warning(f"API响应格式不正确: {response_data}")
                     return None
             else:
-                logger.error(f"API调用失败，状态码: {response.status_code}, 响应: {response.text}")
+                # 只记录响应开头部分，避免解码和输出整个错误页面
+                logger.error("API调用失败，状态码: %s, 响应: %s",
+                             response.status_code, response.content[:200].decode('utf-8', 'replace'))
                 # 如果当前API调用失败，尝试使用备用API
-                if url != "https://api.openai.com/v1/chat/completions":
+                if url != OFFICIAL_API_URL:
                     logger.info("尝试使用官方API进行调用")
                     return self._fallback_api_call_with_history(api_key, model, messages, temperature, max_tokens)
                 return None
                 
         except Exception as e:
-            logger.error(f"调用OpenAI API失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("调用OpenAI API失败: %s", e)
             # 如果当前API调用出现异常，尝试使用备用API
-            if url != "https://api.openai.com/v1/chat/completions":
+            if url != OFFICIAL_API_URL:
                 logger.info("尝试使用官方API进行调用")
                 return self._fallback_api_call_with_history(api_key, model, messages, temperature, max_tokens)
             return None
             
+    def _read_stream_content(self, response, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        """逐行读取SSE流式响应，每段内容回调on_delta，返回拼接后的完整内容"""
+        parts = []
+        with response:
+            for line in response.iter_lines():
+                if not line or not line.startswith(b"data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == b"[DONE]":
+                    break
+                choices = _json_loads(payload).get("choices") or []
+                if not choices:
+                    continue
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    if on_delta is not None:
+                        on_delta(delta)
+        return "".join(parts)
+
     def _fallback_api_call_with_history(self, api_key: str, model: str, messages: List[Dict[str, str]], 
                                       temperature: float = 0.7, max_tokens: int = 2000) -> Optional[str]:
         """备用API调用方法，当主要API调用失败时使用，支持传入完整的消息历史
@@ -4028,57 +4732,31 @@ class WxAutoBridge:
             生成的回复内容，如果调用失败则返回None
         """
         try:
-            # 备用API列表
-            backup_apis = [
-                "https://api.openai.com/v1/chat/completions",
-                "https://openai.wndbac.cn/v1/chat/completions",
-                "https://proxy.geekai.co/v1/chat/completions"
-            ]
-            
-            for url in backup_apis:
-                try:
-                    logger.info(f"尝试使用备用API: {url}")
-                    
-                    # 准备请求头
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {api_key}"
-                    }
-                    
-                    # 准备请求体
-                    data = {
-                        "model": model,
-                        "messages": messages,
-                        "temperature": temperature,
-                        "max_tokens": max_tokens
-                    }
-                    
-                    # 发送请求
-                    response = requests.post(url, headers=headers, json=data, timeout=30)
-                    
-                    # 检查响应状态
-                    if response.status_code == 200:
-                        response_data = response.json()
-                        
-                        # 提取生成的文本
-                        if "choices" in response_data and len(response_data["choices"]) > 0:
-                            message = response_data["choices"][0].get("message", {})
-                            content = message.get("content", "")
-                            
-                            if content:
-                                logger.info(f"备用API调用成功: {url}")
-                                return content.strip()
-                except Exception as e:
-                    logger.warning(f"备用API {url} 调用失败: {e}")
-                    continue
+            # 请求头和请求体对所有备用API相同，只构建一次
+            headers = _auth_headers(api_key)
+            body = _json_dumps_bytes({
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens
+            })
             
-            logger.error("所有API调用尝试均失败")
-            return None
+            return self._race_fallback_apis(headers, body)
         except Exception as e:
-            logger.error(f"备用API调用失败: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("备用API调用失败: %s", e)
             return None
 
+RESPONSE_PREFIX = b"RESPONSE:"
+
+def _write_response(response: Dict[str, Any]):
+    """输出命令结果
+
+    保持json.dumps默认的ASCII转义：Electron端按数据块解码，原始UTF-8多字节字符可能被截断在两块之间。
+    """
+    sys.stdout.flush()  # 先写出文本层中缓冲的日志
+    sys.stdout.buffer.write(RESPONSE_PREFIX + json.dumps(response).encode('ascii') + b"\n")
+    sys.stdout.buffer.flush()
+
 def main():
     """主函数"""
     logger.info("🚀 WxAuto bridge 正在启动...")
@@ -4087,6 +4765,13 @@ def main():
     bridge = WxAutoBridge()
     logger.info("✅ WxAutoBridge 实例已创建")
     
+    # 命令分发表：只开放WxAutoBridge类中定义的公开方法（下划线开头的内部方法不能通过命令调用），启动时构建一次
+    dispatch = {
+        name: getattr(bridge, name)
+        for name, attr in vars(WxAutoBridge).items()
+        if not name.startswith('_') and callable(attr)
+    }
+    
     # 信号处理
     def signal_handler(signum, _):
         logger.info(f"📢 收到信号 {signum}，正在退出...")
@@ -4108,8 +4793,7 @@ def main():
         else:
             logger.warning(f"⚠️ 微信客户端初始化失败: {init_result.get('message')}")
     except Exception as e:
-        logger.error(f"❌ 微信客户端初始化异常: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("❌ 微信客户端初始化异常: %s", e)
     
     logger.info("✅ WxAuto bridge 启动完成，等待命令...")
     
@@ -4118,7 +4802,7 @@ def main():
             try:
                 # 读取命令
                 logger.debug("⏳ 等待命令输入...")
-                line = sys.stdin.readline()
+                line = sys.stdin.buffer.readline()
                 if not line:
                     logger.info("📢 检测到标准输入已关闭，退出程序")
                     break
@@ -4129,7 +4813,7 @@ def main():
                 
                 # 解析命令
                 try:
-                    command_data = json.loads(line)
+                    command_data = _json_loads(line)
                     command_id = command_data.get("id")
                     command = command_data.get("command")
                     params = command_data.get("params", {})
@@ -4151,52 +4835,42 @@ def main():
                         else:
                             logger.info("🔍 消息处理线程未创建")
 
-                    if hasattr(bridge, command):
-                        method = getattr(bridge, command)
-                        if callable(method):
-                            logger.info(f"🔧 执行方法: {command}")
-                            result = method(**params)
-                            logger.info(f"📤 命令执行结果: {result}")
-                        else:
-                            result = {"success": False, "message": f"'{command}' 不是可调用方法"}
-                            logger.error(f"❌ 方法不可调用: {command}")
+                    method = dispatch.get(command)
+                    if method is not None:
+                        logger.info(f"🔧 执行方法: {command}")
+                        result = method(**params)
+                        logger.info(f"📤 命令执行结果: {result}")
                     else:
                         result = {"success": False, "message": f"未知命令: {command}"}
                         logger.error(f"❌ 未知命令: {command}")
 
                         # 列出可用的方法
-                        available_methods = [attr for attr in dir(bridge) if not attr.startswith('_') and callable(getattr(bridge, attr))]
-                        logger.info(f"ℹ️ 可用方法: {available_methods}")
+                        logger.info(f"ℹ️ 可用方法: {sorted(dispatch)}")
                     
                     # 返回结果
                     response = {"id": command_id, **result}
-                    print(f"RESPONSE:{json.dumps(response)}")
-                    sys.stdout.flush()
+                    _write_response(response)
                     
                 except json.JSONDecodeError as e:
                     logger.error(f"❌ 命令解析失败: {e}")
                 except Exception as e:
-                    logger.error(f"❌ 命令执行失败: {e}")
-                    logger.error(traceback.format_exc())
+                    logger.exception("❌ 命令执行失败: %s", e)
                     response = {
                         "id": command_data.get("id") if 'command_data' in locals() else "unknown",
                         "success": False,
                         "message": str(e)
                     }
-                    print(f"RESPONSE:{json.dumps(response)}")
-                    sys.stdout.flush()
+                    _write_response(response)
                     
             except KeyboardInterrupt:
                 logger.info("📢 检测到键盘中断，退出程序")
                 break
             except Exception as e:
-                logger.error(f"❌ 意外错误: {e}")
-                logger.error(traceback.format_exc())
+                logger.exception("❌ 意外错误: %s", e)
                 break
                 
     except Exception as e:
-        logger.error(f"❌ 致命错误: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("❌ 致命错误: %s", e)
     finally:
         logger.info("🛑 WxAuto bridge 已停止")
 
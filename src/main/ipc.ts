@@ -372,6 +372,8 @@ export function registerIpc(mainWindow: BrowserWindow, app: Electron.App) {
     wxAutoService.refreshChatMessages(contactName))
   ipcMain.handle(IpcChannel.WxAuto_GetMessagesFromDb, (_, contactName: string, page: number, perPage: number) =>
     wxAutoService.getMessagesFromDb(contactName, page, perPage))
+  ipcMain.handle(IpcChannel.WxAuto_GetMoreMessagesFromDb, (_, contactName: string, beforeId?: number, limit?: number) =>
+    wxAutoService.getMoreMessagesFromDb(contactName, beforeId, limit))
   ipcMain.handle(IpcChannel.WxAuto_StartMonitoring, (_, contactName: string, autoReply: boolean = false) =>
     wxAutoService.startMonitoring(contactName, autoReply))
   ipcMain.handle(IpcChannel.WxAuto_StopMonitoring, (_, contactName: string) =>
@@ -183,6 +183,8 @@ const api = {
       ipcRenderer.invoke(IpcChannel.WxAuto_RefreshChatMessages, contactName),
     getMessagesFromDb: (contactName: string, page: number, perPage: number) =>
       ipcRenderer.invoke(IpcChannel.WxAuto_GetMessagesFromDb, contactName, page, perPage),
+    getMoreMessagesFromDb: (contactName: string, beforeId?: number, limit?: number) =>
+      ipcRenderer.invoke(IpcChannel.WxAuto_GetMoreMessagesFromDb, contactName, beforeId, limit),
     startMonitoring: (contactName: string, autoReply?: boolean) =>
       ipcRenderer.invoke(IpcChannel.WxAuto_StartMonitoring, contactName, autoReply),
     stopMonitoring: (contactName: string) => ipcRenderer.invoke(IpcChannel.WxAuto_StopMonitoring, contactName),
@@ -289,6 +291,8 @@ if (process.contextIsolated) {
         ipcRenderer.invoke(IpcChannel.WxAuto_RefreshChatMessages, contactName),
       getMessagesFromDb: (contactName: string, page: number, perPage: number) =>
         ipcRenderer.invoke(IpcChannel.WxAuto_GetMessagesFromDb, contactName, page, perPage),
+      getMoreMessagesFromDb: (contactName: string, beforeId?: number, limit?: number) =>
+        ipcRenderer.invoke(IpcChannel.WxAuto_GetMoreMessagesFromDb, contactName, beforeId, limit),
       startMonitoring: (contactName: string, autoReply?: boolean) =>
         ipcRenderer.invoke(IpcChannel.WxAuto_StartMonitoring, contactName, autoReply),
       stopMonitoring: (contactName: string) => ipcRenderer.invoke(IpcChannel.WxAuto_StopMonitoring, contactName),
@@ -198,6 +198,9 @@ const AISalesPage: React.FC = () => {
   // 页面首次挂载标记
   const hasFetchedContactsRef = useRef(false)
 
+  // 当前选中的联系人名称（后台加载完成时用于判断联系人是否已切换）
+  const selectedContactNameRef = useRef<string | null>(null)
+
   // 渲染导航栏
   const renderNavbar = () => (
     <div className="aisales-header">
@@ -903,6 +906,7 @@ const AISalesPage: React.FC = () => {
 
   const selectContact = (contact: Contact) => {
     setSelectedContact(contact)
+    selectedContactNameRef.current = contact.name
     setIsListening(!!contact.is_monitoring)
     setChatMessages([])
     setStoredMessages([])
@@ -940,13 +944,13 @@ const AISalesPage: React.FC = () => {
   }
 
   // 分页状态
-  const [messagePage, setMessagePage] = useState(1)
+  const [beforeId, setBeforeId] = useState<number | null>(null) // 已加载的最早一条消息的ID，用于向前加载
   const [hasMoreMessages, setHasMoreMessages] = useState(false)
   const [loadingMoreMessages, setLoadingMoreMessages] = useState(false)
 
   // 加载更多历史消息
   const loadMoreMessages = async () => {
-    if (!selectedContact || loadingMoreMessages || !hasMoreMessages) {
+    if (!selectedContact || loadingMoreMessages || !hasMoreMessages || beforeId === null) {
       return
     }
 
@@ -955,9 +959,9 @@ const AISalesPage: React.FC = () => {
     setShouldScrollToBottom(false)
 
     try {
-      console.log(`📄 加载更多消息：联系人=${selectedContact.name}, 页码=${messagePage + 1}`)
+      console.log(`📄 加载更多消息：联系人=${selectedContact.name}, before_id=${beforeId}`)
 
-      const result = await wxAutoAPI.getMessagesFromDb(selectedContact.name, messagePage + 1, 20)
+      const result = await wxAutoAPI.getMoreMessagesFromDb(selectedContact.name, beforeId, 20)
 
       if (result.success && result.data?.messages) {
         const newMessages = result.data.messages
@@ -971,7 +975,7 @@ const AISalesPage: React.FC = () => {
         setStoredMessages((prev) => [...newMessages, ...prev])
 
         // 更新分页状态
-        setMessagePage((prev) => prev + 1)
+        setBeforeId(result.data.before_id ?? null)
         setHasMoreMessages(result.data.has_more || false)
 
         // 恢复滚动位置（保持用户当前查看的位置）
@@ -1039,7 +1043,7 @@ const AISalesPage: React.FC = () => {
 
   // 重置分页状态（公共逻辑）
   const resetPaginationState = () => {
-    setMessagePage(1)
+    setBeforeId(null)
     setHasMoreMessages(false)
     setLoadingMoreMessages(false)
   }
@@ -1079,6 +1083,7 @@ const AISalesPage: React.FC = () => {
         setStoredMessages(messages)
         // 设置分页状态
         setHasMoreMessages(data.data?.has_more || false)
+        setBeforeId(data.data?.before_id ?? null)
         console.log(`✅ 刷新完成：从数据库加载了 ${messages.length} 条消息，还有更多：${data.data?.has_more}`)
 
         // 处理回复建议
@@ -1125,6 +1130,11 @@ const AISalesPage: React.FC = () => {
       // 从数据库获取历史消息
       const data = await wxAutoAPI.getMessagesFromDb(contactName, 1, 20)
 
+      // 加载期间已切换到其他联系人，丢弃结果
+      if (selectedContactNameRef.current !== contactName) {
+        return
+      }
+
       if (data.success) {
         const messages = data.data?.messages || []
 
@@ -1134,6 +1144,7 @@ const AISalesPage: React.FC = () => {
         setStoredMessages(messages)
         // 设置分页状态
         setHasMoreMessages(data.data?.has_more || false)
+        setBeforeId(data.data?.before_id ?? null)
         console.log(`✅ 加载完成：从数据库获取了 ${messages.length} 条历史消息，还有更多：${data.data?.has_more}`)
 
         // 处理回复建议
@@ -1226,7 +1237,14 @@ const AISalesPage: React.FC = () => {
               setStoredMessages(messages)
               // 设置分页状态
               setHasMoreMessages(data.data.has_more || false)
+              setBeforeId(data.data.before_id ?? null)
               console.log(`✅ 重新获取成功，显示第一页 ${messages.length} 条消息，还有更多：${data.data.has_more}`)
+
+              // 后端仍在后台保存消息（第一页消息还没有ID），先显示返回的消息，
+              // 在后台从数据库重新加载（会等待保存完成），不阻塞界面
+              if (data.data.pending_save) {
+                loadStoredMessages(selectedContact.name)
+              }
             } else {
               console.log('❌ 后端未返回消息数据')
             }